@@ -0,0 +1,225 @@
+from pydantic import BaseModel, PrivateAttr
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, Hashable, List, NamedTuple, Optional, Tuple, Union
+from collections import OrderedDict
+from datetime import datetime
+from loguru import logger
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+
+class FileCache(BaseModel):
+    """
+    A local directory of downloaded files, keyed by file name and remote file facts
+
+    Class attributes
+    ----------
+
+    Attributes
+    ----------
+    path : str
+        Cache directory (created if it doesn't exist)
+    max_bytes : int = 20 GiB
+        Total size of cached files above which the least recently used are evicted
+
+
+    Methods
+    ----------
+    get(filename: str, facts: Optional[Dict[str, str]] = None) -> Optional[bytes]
+        Return the cached content for the file, if present
+    put(filename: str, data: bytes, facts: Optional[Dict[str, str]] = None) -> None
+        Store the content for the file, then evict down to max_bytes
+    """
+
+    path: str
+    max_bytes: int = 20 * 1024**3
+
+    _lock: Any = PrivateAttr()
+
+    def __init__(self, **data: Any) -> None:
+        super().__init__(**data)
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def _key(self, filename: str, facts: Optional[Dict[str, str]] = None) -> str:
+        """Entry name from the file name and, when known, the MLSD 'size' and 'modify' facts"""
+        facts = facts or {}
+        fingerprint = '\t'.join([filename, facts.get('size', ''), facts.get('modify', '')])
+        digest = hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+        return f'{digest}_{filename}'
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _evict(self) -> None:
+        """Remove least recently used entries until the total size is within max_bytes"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                logger.info('Evicted {path} from cache', path=path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def get(self, filename: str, facts: Optional[Dict[str, str]] = None) -> Optional[bytes]:
+        path = os.path.join(self.path, self._key(filename, facts))
+        with self._lock:
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                return None
+            if facts is not None and 'size' in facts and len(data) != int(facts['size']):
+                logger.info('Discarding incomplete cache entry for {filename}', filename=filename)
+                os.remove(path)
+                return None
+            # mark as recently used
+            os.utime(path)
+        return data
+
+    def put(self, filename: str, data: bytes, facts: Optional[Dict[str, str]] = None) -> None:
+        path = os.path.join(self.path, self._key(filename, facts))
+        # write to a hidden temporary file then rename, so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        with self._lock:
+            self._evict()
+
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    media_type: str
+    headers: Dict[str, str]
+
+
+class ResponseCache(BaseModel):
+    """
+    An in-memory cache of response bodies, valid for a generation of the data they were read from
+
+    Entries are dropped when the generation changes, when they are older than ttl, and, least recently used
+    first, when the total size is over max_bytes. While the generation is unknown nothing is cached.
+
+    Class attributes
+    ----------
+
+    Attributes
+    ----------
+    ttl : float = 60
+        Seconds an entry is served for
+    max_bytes : int = 128 MiB
+        Total size of the cached bodies
+    max_entry_bytes : int = 16 MiB
+        Size above which a body is not cached
+    generation : Optional[int]
+        The current generation (None if unknown), read-only
+    modified : Optional[datetime]
+        When the data was last written, as of the current generation (None if unknown), read-only
+
+
+    Methods
+    ----------
+    get(key: Hashable) -> Optional[CachedResponse]
+        Return the cached response, if present and current
+    put(key: Hashable, response: CachedResponse, generation: Optional[int]) -> None
+        Store the response if it was read in the current generation, then evict down to max_bytes
+    tee(key: Hashable, chunks: AsyncIterator[Union[str, bytes]], media_type: str, headers: Dict[str, str])
+        -> AsyncGenerator[Union[str, bytes], None]
+        Pass a streamed body through, and store it once complete
+    set_generation(generation: Optional[int], modified: Optional[datetime] = None) -> None
+        Set the current generation (None if unknown) and when it was written, dropping all entries if it changed
+    clear() -> None
+        Drop all entries
+    """
+
+    ttl: float = 60
+    max_bytes: int = 128 * 1024**2
+    max_entry_bytes: int = 16 * 1024**2
+
+    _entries: Any = PrivateAttr()
+    _size: int = PrivateAttr()
+    _generation: Optional[int] = PrivateAttr()
+    _modified: Optional[datetime] = PrivateAttr()
+
+    def __init__(self, **data: Any) -> None:
+        super().__init__(**data)
+        self._entries = OrderedDict()
+        self._size = 0
+        self._generation = None
+        self._modified = None
+
+    def _remove(self, key: Hashable) -> None:
+        _, response = self._entries.pop(key)
+        self._size -= len(response.body)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._size = 0
+
+    @property
+    def generation(self) -> Optional[int]:
+        return self._generation
+
+    @property
+    def modified(self) -> Optional[datetime]:
+        return self._modified
+
+    def set_generation(self, generation: Optional[int], modified: Optional[datetime] = None) -> None:
+        if generation != self._generation:
+            self.clear()
+            self._generation = generation
+        self._modified = modified if generation is not None else None
+
+    def get(self, key: Hashable) -> Optional[CachedResponse]:
+        if key not in self._entries:
+            return None
+        expires, response = self._entries[key]
+        if time.monotonic() >= expires:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return response
+
+    def put(self, key: Hashable, response: CachedResponse, generation: Optional[int]) -> None:
+        if generation is None or generation != self._generation or len(response.body) > self.max_entry_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, response)
+        self._size += len(response.body)
+        while self._size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    async def tee(
+        self, key: Hashable, chunks: AsyncIterator[Union[str, bytes]], media_type: str, headers: Dict[str, str]
+    ) -> AsyncGenerator[Union[str, bytes], None]:
+        generation = self._generation
+        body: Optional[List[bytes]] = [] if generation is not None else None
+        size = 0
+        async for chunk in chunks:
+            yield chunk
+            if body is not None:
+                data = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+                size += len(data)
+                if size > self.max_entry_bytes:
+                    body = None
+                else:
+                    body.append(data)
+        if body is not None and generation is not None:
+            self.put(key, CachedResponse(b''.join(body), media_type, headers), generation)
@@ -0,0 +1,106 @@
+from pydantic import BaseModel, PrivateAttr
+from typing import Any, Callable, Dict, Generator, List, Optional
+from enum import Enum
+from loguru import logger
+import datetime
+import pytz
+from . import db
+
+
+class FileStateEnum(str, Enum):
+    """Progress of a file through the pipeline, in order"""
+
+    listed = 'listed'
+    downloaded = 'downloaded'
+    classified = 'classified'
+    loaded = 'loaded'
+
+
+class Checkpoint(BaseModel):
+    """
+    Records the per-file progress of a pipeline run in a database table, so that a restarted run can resume
+
+    Class attributes
+    ----------
+
+    Attributes
+    ----------
+    table_name : str = 'contents'
+        Table of file facts (see pubmed.updatefiles_content2facts_transformer)
+    host : str = 'localhost'
+        Database host
+    port : int = 28015
+        Client drivers port
+    user : Optional[str]
+        Db user name
+    password : Optional[str]
+        Db password
+
+
+    Methods
+    ----------
+    resume(facts: List[Dict[str, Any]]) -> List[Dict[str, Any]]
+        Persist new facts as 'listed' and return the facts of files that are not yet loaded, with their state
+    mark(filename: str, state: FileStateEnum, documents: Optional[List[Dict[str, Any]]] = None) -> None
+        Record that the file reached the state; documents are kept with a 'classified' file until it is loaded
+    documents(filename: str) -> List[Dict[str, Any]]
+        The documents recorded for a 'classified' file
+    """
+
+    table_name: str = 'contents'
+    host: str = 'localhost'
+    port: int = 28015
+    user: Optional[str] = 'admin'
+    password: Optional[str] = ''
+
+    _db: Any = PrivateAttr()
+
+    def __init__(self, **data: Any) -> None:
+        super().__init__(**data)
+        self._db = db.Db(host=self.host, port=self.port, user=self.user, password=self.password)
+
+    def resume(self, facts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        ids = [fact['id'] for fact in facts]
+        known = self._db.get_many(table_name=self.table_name, ids=ids, fields=['id', 'state'])
+        # files recorded before checkpointing was introduced have no state and were fully processed
+        states = {item['id']: item.get('state', FileStateEnum.loaded) for item in known}
+        new_facts = [fact for fact in facts if fact['id'] not in states]
+        for fact in new_facts:
+            fact['state'] = FileStateEnum.listed
+            states[fact['id']] = FileStateEnum.listed
+        if new_facts:
+            self._db.set_many(table_name=self.table_name, data=new_facts)
+
+        pending = []
+        for fact in facts:
+            state = FileStateEnum(states[fact['id']])
+            if state != FileStateEnum.loaded:
+                pending.append(dict(fact, state=state))
+        logger.info('{n} of {t} files to process', n=len(pending), t=len(facts))
+        return pending
+
+    def mark(self, filename: str, state: FileStateEnum, documents: Optional[List[Dict[str, Any]]] = None) -> None:
+        data = {
+            'state': state,
+            'state_updated': datetime.datetime.now(pytz.UTC),
+            'documents': documents,
+        }
+        self._db.update(table_name=self.table_name, id=filename, data=data)
+        logger.info('{filename}: {state}', filename=filename, state=state.value)
+
+    def documents(self, filename: str) -> List[Dict[str, Any]]:
+        fact = self._db.get(table_name=self.table_name, id=filename)
+        if fact is None or fact.get('documents') is None:
+            return []
+        return fact['documents']
+
+
+def checkpoint_filter(
+    checkpoint: Checkpoint,
+) -> Callable[[Generator[Dict[str, Any], None, None]], Generator[Dict[str, Any], None, None]]:
+    """Select the facts of files that are not yet loaded, annotated with their 'state'"""
+
+    def _checkpoint_filter(facts):
+        yield from checkpoint.resume(list(facts))
+
+    return _checkpoint_filter
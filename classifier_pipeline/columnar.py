@@ -0,0 +1,144 @@
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, List, NamedTuple
+import io
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # the columnar formats are offered only when the optional pyarrow package is installed
+    pyarrow = None
+
+
+BATCH_ROWS: int = 10000
+
+
+class Column(NamedTuple):
+    name: str
+    type: str  # 'string', 'double', 'int8' or 'timestamp'
+    path: List[str]  # to the value within the item
+
+
+DOCUMENT_COLUMNS: List[Column] = [
+    Column('pmid', 'string', ['pmid']),
+    Column('pmc', 'string', ['pmc']),
+    Column('doi', 'string', ['doi']),
+    Column('title', 'string', ['title']),
+    Column('journal', 'string', ['journal', 'title']),
+    Column('abstract', 'string', ['abstract']),
+    Column('classification', 'int8', ['classification']),
+    Column('probability', 'double', ['probability']),
+    Column('model_version', 'string', ['model_version']),
+    Column('pub_date', 'timestamp', ['pub_date']),
+    Column('last_updated', 'timestamp', ['last_updated']),
+]
+
+MERGE_COLUMNS: List[Column] = [
+    Column('pmid', 'string', ['pmid']),
+    Column('doi', 'string', ['doi']),
+    Column('articleCitation', 'string', ['articleCitation']),
+    Column('pubDate', 'timestamp', ['pubDate']),
+    Column('lastUpdated', 'timestamp', ['lastUpdated']),
+    Column('authorName', 'string', ['authorName']),
+    Column('emailRecipientAddress', 'string', ['emailRecipientAddress']),
+]
+
+
+def available() -> bool:
+    return pyarrow is not None
+
+
+def _arrow_type(type: str) -> Any:
+    if type == 'timestamp':
+        return pyarrow.timestamp('ms', tz='UTC')
+    return pyarrow.type_for_alias(type)
+
+
+def to_schema(columns: List[Column]) -> Any:
+    return pyarrow.schema([(column.name, _arrow_type(column.type)) for column in columns])
+
+
+def _get(item: Dict[str, Any], path: List[str]) -> Any:
+    value: Any = item
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def _to_batch(items: List[Dict[str, Any]], columns: List[Column], schema: Any) -> Any:
+    arrays = [
+        pyarrow.array([_get(item, column.path) for item in items], type=field.type)
+        for column, field in zip(columns, schema)
+    ]
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+async def _batches(
+    items: AsyncIterator[Dict[str, Any]], columns: List[Column], schema: Any, rows: int
+) -> AsyncGenerator[Any, None]:
+    chunk = []
+    async for item in items:
+        chunk.append(item)
+        if len(chunk) == rows:
+            yield _to_batch(chunk, columns, schema)
+            chunk = []
+    if chunk:
+        yield _to_batch(chunk, columns, schema)
+
+
+class _Sink(io.RawIOBase):
+    """A write-only stream whose contents are taken as they're written"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def take(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+async def as_arrow(
+    items: AsyncIterator[Dict[str, Any]], columns: List[Column], rows: int = BATCH_ROWS
+) -> AsyncGenerator[bytes, None]:
+    """Stream the items in the Arrow IPC streaming format, a record batch of (at most) rows items at a time"""
+    schema = to_schema(columns)
+    sink = _Sink()
+    writer = pyarrow.ipc.new_stream(sink, schema)
+    # the schema, so that readers can start (or read an empty stream)
+    yield sink.take()
+    async for batch in _batches(items, columns, schema, rows):
+        writer.write_batch(batch)
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+async def as_parquet(
+    items: AsyncIterator[Dict[str, Any]], columns: List[Column], rows: int = BATCH_ROWS
+) -> AsyncGenerator[bytes, None]:
+    """Stream the items as a Parquet file, a row group of (at most) rows items at a time"""
+    schema = to_schema(columns)
+    sink = _Sink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    async for batch in _batches(items, columns, schema, rows):
+        writer.write_table(pyarrow.Table.from_batches([batch], schema=schema))
+        yield sink.take()
+    # the footer, which readers need to read the row groups
+    writer.close()
+    yield sink.take()
@@ -0,0 +1,151 @@
+from typing import Any, Dict, List, Optional
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd is offered only when the optional zstandard package is installed
+    zstandard = None
+
+
+# in order of preference
+ENCODINGS: List[str] = (['zstd'] if zstandard is not None else []) + ['gzip']
+COMPRESSIBLE_TYPES: List[str] = [
+    'application/json',
+    'application/x-ndjson',
+    'application/vnd.apache.arrow.stream',
+    'text/csv',
+    'text/html',
+    'text/plain',
+]
+
+
+def negotiate(accept_encoding: str, encodings: List[str] = ENCODINGS) -> Optional[str]:
+    """Choose the most preferred of the encodings that the Accept-Encoding header allows, if any"""
+    qualities: Dict[str, float] = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[coding] = quality
+    for encoding in encodings:
+        if qualities.get(encoding, qualities.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+
+class _Compressor:
+    """Compress a body chunk by chunk, each chunk flushed so the client can decode it as soon as it arrives"""
+
+    def __init__(self, encoding: str, level: Optional[int] = None) -> None:
+        self._compress: Any = None
+        if encoding == 'gzip':
+            self._compress = zlib.compressobj(level if level is not None else 6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self._flush = zlib.Z_SYNC_FLUSH
+        elif encoding == 'zstd' and zstandard is not None:
+            self._compress = zstandard.ZstdCompressor(level=level if level is not None else 3).compressobj()
+            self._flush = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            raise ValueError(f'Unsupported encoding: {encoding}')
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compress.compress(data) + self._compress.flush(self._flush)
+
+    def finish(self) -> bytes:
+        return self._compress.flush()
+
+
+class CompressionMiddleware:
+    """
+    Compress responses as negotiated by Accept-Encoding, streamed chunk by chunk rather than buffered
+
+    Attributes
+    ----------
+    app : ASGIApp
+        The application
+    minimum_size : int = 500
+        Size in bytes under which a response sent whole is not compressed
+    level : Optional[int]
+        Compression level (the encoding's default if None)
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 500, level: Optional[int] = None) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate(Headers(scope=scope).get('accept-encoding', ''))
+        start: Optional[Message] = None
+        compressor: Optional[_Compressor] = None
+        passthrough = False
+
+        async def _send(message: Message) -> None:
+            nonlocal start, compressor, passthrough
+            if message['type'] == 'http.response.start':
+                headers = MutableHeaders(raw=message['headers'])
+                headers.add_vary_header('Accept-Encoding')
+                media_type = headers.get('content-type', '').split(';')[0].strip()
+                content_length = headers.get('content-length')
+                passthrough = (
+                    encoding is None
+                    or 'content-encoding' in headers
+                    or media_type not in COMPRESSIBLE_TYPES
+                    or (
+                        content_length is not None
+                        and content_length.isdigit()
+                        and int(content_length) < self.minimum_size
+                    )
+                )
+                if passthrough:
+                    # sent at once, so that e.g. an event stream's headers don't wait on its first event
+                    await send(message)
+                else:
+                    # held until the first body message shows whether the response is streamed
+                    start = message
+                return
+            if message['type'] != 'http.response.body' or passthrough:
+                await send(message)
+                return
+            body = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if start is not None:
+                headers = MutableHeaders(raw=start['headers'])
+                if not more_body and len(body) < self.minimum_size:
+                    passthrough = True
+                    await send(start)
+                    await send(message)
+                    return
+                assert encoding is not None
+                compressor = _Compressor(encoding, self.level)
+                headers['Content-Encoding'] = encoding
+                if more_body:
+                    if 'content-length' in headers:
+                        del headers['Content-Length']
+                else:
+                    body = compressor.compress(body) + compressor.finish()
+                    headers['Content-Length'] = str(len(body))
+                    await send(start)
+                    await send({'type': 'http.response.body', 'body': body, 'more_body': False})
+                    return
+                await send(start)
+                start = None
+            assert compressor is not None
+            data = compressor.compress(body) if body else b''
+            if not more_body:
+                data += compressor.finish()
+            await send({'type': 'http.response.body', 'body': data, 'more_body': more_body})
+
+        await self.app(scope, receive, _send)
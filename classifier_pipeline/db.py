@@ -1,11 +1,22 @@
 from pydantic import BaseModel, PrivateAttr
-from typing import Any, Optional, NamedTuple, Dict
+from typing import Any, AsyncIterator, Deque, Iterator, Optional, NamedTuple, Dict, List, Tuple
+from contextlib import asynccontextmanager, contextmanager
+from collections import deque
 from rethinkdb import RethinkDB
+from rethinkdb.errors import ReqlDriverError, ReqlOpFailedError
+from rethinkdb.net import Cursor
+from loguru import logger
+from datetime import datetime
+import asyncio
+import threading
+import time
 
 
 MAX_NUM_ITEMS: int = 100000
 MAX_DATE: str = '9999-12-31'
 MIN_DATE: str = '1400-01-01'
+# documents of {'id': <table name>, 'generation': int, 'modified': datetime}, counting writes to the table
+META_TABLE: str = 'meta'
 
 
 class Table(NamedTuple):
@@ -15,6 +26,177 @@ class Table(NamedTuple):
     table: Any
 
 
+class ConnectionPool(BaseModel):
+    """
+    A thread-safe pool of connections to the data store
+
+    Class attributes
+    ----------
+
+    Attributes
+    ----------
+    host : str = 'localhost'
+        Database host
+    port : int = 28015
+        Client drivers port
+    user : Optional[str]
+        Db user name
+    password : Optional[str]
+        Db password
+    min_size : int = 0
+        Idle connections kept open regardless of idle_timeout
+    max_size : int = 10
+        Connections open at once; further requests for a connection wait for one to be released
+    idle_timeout : Optional[float] = 300
+        Seconds after which an idle connection is closed (None to keep idle connections open)
+    ping_after : Optional[float] = 30
+        Seconds idle after which a connection is checked with a round trip before it is lent (None to never check)
+    acquire_timeout : Optional[float] = None
+        Seconds to wait for a connection before raising TimeoutError (None to wait indefinitely)
+
+
+    Methods
+    ----------
+    connection() -> ContextManager
+        Borrow a live connection for the duration of the context; a connection that fails with a driver error
+        (e.g. a dropped socket) is discarded, together with the idle connections opened before it
+    acquire() -> Any
+        Borrow a live connection; it must be returned with release
+    release(conn: Any, discard: bool = False) -> None
+        Return a borrowed connection to the pool, or close it
+    close() -> None
+        Close the idle connections
+    """
+
+    host: str = 'localhost'
+    port: int = 28015
+    user: Optional[str] = 'admin'
+    password: Optional[str] = ''
+    min_size: int = 0
+    max_size: int = 10
+    idle_timeout: Optional[float] = 300
+    ping_after: Optional[float] = 30
+    acquire_timeout: Optional[float] = None
+
+    _r: Any = PrivateAttr()
+    _idle: Deque[Tuple[Any, float]] = PrivateAttr()
+    _size: int = PrivateAttr()
+    _available: Any = PrivateAttr()
+
+    def __init__(self, **data: Any) -> None:
+        super().__init__(**data)
+        if self.max_size < 1 or not 0 <= self.min_size <= self.max_size:
+            raise ValueError('Pool sizes must satisfy 0 <= min_size <= max_size and max_size > 0')
+        self._r = RethinkDB()
+        self._idle = deque()
+        self._size = 0
+        self._available = threading.Condition()
+
+    def _open(self):
+        return self._r.connect(host=self.host, port=self.port, user=self.user, password=self.password)
+
+    @staticmethod
+    def _close(conn: Any) -> None:
+        try:
+            conn.close(noreply_wait=False)
+        except ReqlDriverError:
+            pass
+
+    def _is_alive(self, conn: Any, idle: float) -> bool:
+        if not conn.is_open():
+            return False
+        if self.ping_after is not None and idle >= self.ping_after:
+            try:
+                self._r.expr(0).run(conn)
+            except ReqlDriverError:
+                return False
+        return True
+
+    def _prune(self, now: float) -> None:
+        """Close connections idle for longer than idle_timeout, oldest first, down to min_size"""
+        if self.idle_timeout is None:
+            return
+        while len(self._idle) > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.popleft()
+            self._size -= 1
+            self._close(conn)
+
+    def _take(self, deadline: Optional[float]) -> Tuple[Any, float]:
+        """Take an idle connection (and how long it was idle), or reserve room to open one (None)"""
+        with self._available:
+            while True:
+                now = time.monotonic()
+                self._prune(now)
+                if self._idle:
+                    # most recently released first, so that surplus connections age out
+                    conn, released = self._idle.pop()
+                    return conn, now - released
+                if self._size < self.max_size:
+                    self._size += 1
+                    return None, 0
+                remaining = None if deadline is None else deadline - now
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f'No database connection available after {self.acquire_timeout}s')
+                self._available.wait(timeout=remaining)
+
+    def acquire(self) -> Any:
+        deadline = None if self.acquire_timeout is None else time.monotonic() + self.acquire_timeout
+        while True:
+            conn, idle = self._take(deadline)
+            if conn is None:
+                break
+            # checked outside the lock, so that a slow ping doesn't hold up the other threads
+            try:
+                alive = self._is_alive(conn, idle)
+            except BaseException:
+                self.release(conn, discard=True)
+                raise
+            if alive:
+                return conn
+            self.release(conn, discard=True)
+        try:
+            return self._open()
+        except BaseException:
+            with self._available:
+                self._size -= 1
+                self._available.notify()
+            raise
+
+    def release(self, conn: Any, discard: bool = False) -> None:
+        with self._available:
+            if discard or not conn.is_open():
+                self._size -= 1
+                self._close(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._available.notify()
+
+    def _discard_idle(self) -> None:
+        with self._available:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                self._close(conn)
+
+    @contextmanager
+    def connection(self) -> Iterator[Any]:
+        conn = self.acquire()
+        try:
+            yield conn
+        except ReqlDriverError:
+            # a dropped socket usually means the server went away, taking the other connections with it
+            self.release(conn, discard=True)
+            self._discard_idle()
+            raise
+        except BaseException:
+            self.release(conn)
+            raise
+        self.release(conn)
+
+    def close(self) -> None:
+        self._discard_idle()
+
+
 class Db(BaseModel):
     """
     Represents the data store
@@ -34,12 +216,26 @@ class Db(BaseModel):
         Db user name
     password : Optional[str]
         Db password
+    max_connections : int = 10
+        Size of the connection pool that queries borrow from
+    retries : int = 3
+        Times a query is retried on a driver error (e.g. the database restarted), with exponential backoff
+    retry_delay : float = 1.0
+        Seconds to wait before the first retry
 
 
     Methods
     ----------
-    access_table() -> Table:
-        Provide for a database table if it doesn't already exist
+    access_table(table_name: str, refresh: bool = False) -> Table:
+        Provide for a database table if it doesn't already exist; the existence check is cached per table
+        unless refresh is set. The connection provided is dedicated to the caller and reopened if closed
+    get_many(table_name: str, ids: List[Any], fields: Optional[List[str]] = None) -> List[Dict[str, Any]]
+        Retrieve the documents (optionally only the fields) for the ids that exist, in a single query
+    guarantee_index(table_name: str, index_name: str, fields: Optional[List[str]] = None) -> None
+        Create the secondary index if it doesn't already exist, and wait for it; the index is on the field
+        of the same name, or compound over the fields
+    invalidate(table_name: Optional[str] = None) -> None
+        Forget the cached handle for the table (or all tables) so the next access re-validates
     set(table_name: str, data: Dict[str, Any]) -> Dict[str, int]
         Either insert the document or replace it if the id exists and return status flags
         {
@@ -51,66 +247,317 @@ class Db(BaseModel):
             "unchanged": int
         }
         see https://rethinkdb.com/api/python/insert; https://rethinkdb.com/api/python/replace
+    update(table_name: str, id: Any, data: Dict[str, Any]) -> Dict[str, int]
+        Merge the fields into the existing document with the id and return status flags
+        see https://rethinkdb.com/api/python/update
+    set_many(table_name: str, data: List[Dict[str, Any]]) -> Dict[str, int]
+        As for set, but for a list of documents in a single query; status flags are summed over the list
+    increment_generation(table_name: str) -> Dict[str, int]
+        Count a write to the table in its generation (see META_TABLE), timed, and return status flags
+    close() -> None
+        Close the database connections
     """
 
     _r: Any = PrivateAttr()
     _conn: Any = PrivateAttr()
+    _pool: Any = PrivateAttr()
     _db: Any = PrivateAttr()
+    _tables: Dict[str, Any] = PrivateAttr()
+    _schema_lock: Any = PrivateAttr()
 
     host: str = 'localhost'
     port: int = 28015
     db_name: str = 'classifier'
     user: Optional[str] = 'admin'
     password: Optional[str] = ''
+    max_connections: int = 10
+    retries: int = 3
+    retry_delay: float = 1.0
 
     def __init__(self, **data: Any) -> None:
         super().__init__(**data)
         self._r = RethinkDB()
         self._db = None
         self._conn = None
+        self._pool = ConnectionPool(
+            host=self.host, port=self.port, user=self.user, password=self.password, max_size=self.max_connections
+        )
+        self._tables = {}
+        # the db and table checks (and their cache) are shared by the threads using this instance
+        self._schema_lock = threading.RLock()
 
     def _connect(self):
         conn = None
         if self._conn is not None:
+            if not self._conn.is_open():
+                self._conn.reconnect(noreply_wait=False)
             conn = self._conn
         else:
             self._conn = self._r.connect(host=self.host, port=self.port, user=self.user, password=self.password)
             conn = self._conn
         return conn
 
+    def _run(self, query: Any) -> Any:
+        """Run the query on a pooled connection, retrying on driver errors; cursors are read to a list"""
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                with self._pool.connection() as conn:
+                    result = query.run(conn)
+                    if isinstance(result, Cursor):
+                        result = list(result)
+                    return result
+            except ReqlDriverError as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning('Database error: {e}; retrying in {delay}s', e=e, delay=delay)
+                time.sleep(delay)
+                delay *= 2
+
+    def _create(self, query: Any) -> None:
+        """Run a db, table or index create; one created by another client in the meantime is as good"""
+        try:
+            self._run(query)
+        except ReqlOpFailedError as e:
+            if 'already exists' not in str(e):
+                raise
+
     def _guarantee_db(self):
         db = None
-        conn = self._connect()
-        if self._db is not None:
-            db = self._db
-        else:
-            dbs = self._r.db_list().run(conn)
-            if self.db_name not in dbs:
-                self._r.db_create(self.db_name).run(conn)
-            self._db = self._r.db(self.db_name)
-            db = self._db
+        with self._schema_lock:
+            if self._db is not None:
+                db = self._db
+            else:
+                dbs = self._run(self._r.db_list())
+                if self.db_name not in dbs:
+                    self._create(self._r.db_create(self.db_name))
+                self._db = self._r.db(self.db_name)
+                db = self._db
         return db
 
-    def _guarantee_table(self, table_name: str) -> Table:
+    def _guarantee_table(self, table_name: str, refresh: bool = False) -> Any:
         table = None
-        conn = self._connect()
-        db = self._guarantee_db()
-        tables = db.table_list().run(conn)
+        with self._schema_lock:
+            db = self._guarantee_db()
+            if table_name in self._tables and not refresh:
+                table = self._tables[table_name]
+            else:
+                tables = self._run(db.table_list())
+                if table_name not in tables:
+                    self._create(db.table_create(table_name))
+                table = db.table(table_name)
+                self._tables[table_name] = table
+        return table
+
+    def access_table(self, table_name: str, refresh: bool = False) -> Table:
+        table = self._guarantee_table(table_name, refresh=refresh)
+        return Table(self._r, self._connect(), self._db, table)
 
-        if table_name not in tables:
-            db.table_create(table_name).run(conn)
-        table = db.table(table_name)
-        return Table(self._r, conn, db, table)
+    def guarantee_index(self, table_name: str, index_name: str, fields: Optional[List[str]] = None) -> None:
+        table = self._guarantee_table(table_name)
+        indexes = self._run(table.index_list())
+        if index_name not in indexes:
+            if fields is None:
+                self._create(table.index_create(index_name))
+            else:
+                self._create(table.index_create(index_name, [self._r.row[field] for field in fields]))
+        self._run(table.index_wait(index_name))
 
-    def access_table(self, table_name: str) -> Table:
-        return self._guarantee_table(table_name)
+    def invalidate(self, table_name: Optional[str] = None) -> None:
+        with self._schema_lock:
+            if table_name is None:
+                self._tables.clear()
+            else:
+                self._tables.pop(table_name, None)
 
     def get(self, table_name: str, id: Any) -> Dict[str, Any]:
-        _, conn, _, table = self._guarantee_table(table_name)
-        return table.get(id).run(conn)
+        table = self._guarantee_table(table_name)
+        return self._run(table.get(id))
+
+    def get_many(self, table_name: str, ids: List[Any], fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        if not ids:
+            return []
+        table = self._guarantee_table(table_name)
+        q = table.get_all(*ids)
+        if fields is not None:
+            q = q.pluck(*fields)
+        return self._run(q)
 
     def set(self, table_name: str, data: Dict[str, Any]) -> Dict[str, int]:
         set_result = None
-        _, conn, _, table = self._guarantee_table(table_name)
-        set_result = table.insert(data, conflict='replace').run(conn)
+        table = self._guarantee_table(table_name)
+        set_result = self._run(table.insert(data, conflict='replace'))
         return set_result
+
+    def update(self, table_name: str, id: Any, data: Dict[str, Any]) -> Dict[str, int]:
+        update_result = None
+        table = self._guarantee_table(table_name)
+        update_result = self._run(table.get(id).update(data))
+        return update_result
+
+    def set_many(self, table_name: str, data: List[Dict[str, Any]]) -> Dict[str, int]:
+        set_result = None
+        table = self._guarantee_table(table_name)
+        set_result = self._run(table.insert(data, conflict='replace'))
+        return set_result
+
+    def increment_generation(self, table_name: str) -> Dict[str, int]:
+        meta = self._guarantee_table(META_TABLE)
+        return self._run(
+            meta.insert(
+                {'id': table_name, 'generation': 1, 'modified': self._r.now()},
+                conflict=lambda id, old, new: old.merge(
+                    {'generation': old['generation'].default(0).add(1), 'modified': new['modified']}
+                ),
+            )
+        )
+
+    def close(self) -> None:
+        """Close the pooled connections and the connection provided by access_table"""
+        self._pool.close()
+        if self._conn is not None:
+            self._conn.close(noreply_wait=False)
+            self._conn = None
+
+
+class AsyncDb(BaseModel):
+    """
+    Represents the data store for asyncio applications, with a pool of connections
+
+    Class attributes
+    ----------
+
+    Attributes
+    ----------
+    host : str = 'localhost'
+        Database host
+    port : int = 28015
+        Client drivers port
+    db : str = 'classifier'
+        Database name
+    user : Optional[str]
+        Db user name
+    password : Optional[str]
+        Db password
+    max_connections : int = 10
+        Connections open at once; further requests for a connection wait for one to be released
+    max_feeds : int = 100
+        Changefeed connections open at once; further requests wait for one to be closed
+
+
+    Methods
+    ----------
+    connection() -> AsyncContextManager
+        Borrow an open connection for the duration of the context; a connection is reused after it is
+        released, unless an error was raised in the context
+    feed_connection() -> AsyncContextManager
+        Open a connection dedicated to a long-lived changefeed for the duration of the context, outside of
+        the pool so as not to hold up other queries
+    table(table_name: str) -> Any
+        The query term for the table
+    guarantee_table(table_name: str) -> None
+        Create the database and table if they don't already exist
+    guarantee_index(table_name: str, index_name: str, fields: Optional[List[str]] = None) -> None
+        As for Db.guarantee_index
+    generations(table_name: str) -> AsyncIterator[Tuple[int, Optional[datetime]]]
+        Follow the generation of the table and when it was last modified, if known (see META_TABLE): the
+        current one, then each change; a feed connection is held until the iteration is stopped
+    close() -> None
+        Close the idle connections
+    """
+
+    _r: Any = PrivateAttr()
+    _idle: List[Any] = PrivateAttr()
+    _available: Any = PrivateAttr()
+
+    host: str = 'localhost'
+    port: int = 28015
+    db_name: str = 'classifier'
+    user: Optional[str] = 'admin'
+    password: Optional[str] = ''
+    max_connections: int = 10
+    max_feeds: int = 100
+
+    _feeds: Any = PrivateAttr()
+
+    def __init__(self, **data: Any) -> None:
+        super().__init__(**data)
+        self._r = RethinkDB()
+        self._r.set_loop_type('asyncio')
+        self._idle = []
+        self._available = None
+        self._feeds = None
+
+    @property
+    def r(self) -> Any:
+        return self._r
+
+    async def _connect(self):
+        return await self._r.connect(host=self.host, port=self.port, user=self.user, password=self.password)
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[Any]:
+        if self._available is None:
+            # created on first use, within the running event loop
+            self._available = asyncio.Semaphore(self.max_connections)
+        async with self._available:
+            conn = None
+            while self._idle and conn is None:
+                candidate = self._idle.pop()
+                if candidate.is_open():
+                    conn = candidate
+            if conn is None:
+                conn = await self._connect()
+            try:
+                yield conn
+            except BaseException:
+                # the connection may hold an unfinished query
+                await conn.close(noreply_wait=False)
+                raise
+            if conn.is_open():
+                self._idle.append(conn)
+
+    @asynccontextmanager
+    async def feed_connection(self) -> AsyncIterator[Any]:
+        if self._feeds is None:
+            self._feeds = asyncio.Semaphore(self.max_feeds)
+        async with self._feeds:
+            conn = await self._connect()
+            try:
+                yield conn
+            finally:
+                await conn.close(noreply_wait=False)
+
+    def table(self, table_name: str) -> Any:
+        return self._r.db(self.db_name).table(table_name)
+
+    async def guarantee_table(self, table_name: str) -> None:
+        async with self.connection() as conn:
+            dbs = await self._r.db_list().run(conn)
+            if self.db_name not in dbs:
+                await self._r.db_create(self.db_name).run(conn)
+            tables = await self._r.db(self.db_name).table_list().run(conn)
+            if table_name not in tables:
+                await self._r.db(self.db_name).table_create(table_name).run(conn)
+
+    async def guarantee_index(self, table_name: str, index_name: str, fields: Optional[List[str]] = None) -> None:
+        table = self.table(table_name)
+        async with self.connection() as conn:
+            indexes = await table.index_list().run(conn)
+            if index_name not in indexes:
+                if fields is None:
+                    await table.index_create(index_name).run(conn)
+                else:
+                    await table.index_create(index_name, [self._r.row[field] for field in fields]).run(conn)
+            await table.index_wait(index_name).run(conn)
+
+    async def generations(self, table_name: str) -> AsyncIterator[Tuple[int, Optional[datetime]]]:
+        async with self.feed_connection() as conn:
+            changes = await self.table(META_TABLE).get(table_name).changes(include_initial=True).run(conn)
+            async for change in changes:
+                new_val = change.get('new_val') or {}
+                yield new_val.get('generation', 0), new_val.get('modified')
+
+    async def close(self) -> None:
+        while self._idle:
+            await self._idle.pop().close(noreply_wait=False)
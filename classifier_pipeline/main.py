@@ -1,9 +1,17 @@
-from typing import Dict, Any, Generator
-from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import StreamingResponse
-from datetime import datetime
+from typing import Dict, Any, AsyncGenerator, AsyncIterator, Callable, List, NamedTuple, Optional, Tuple
+from fastapi import FastAPI, Header, HTTPException, Query
+from fastapi.responses import Response, StreamingResponse
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
 import pytz
-from classifier_pipeline.db import Db, MAX_DATE, MIN_DATE, MAX_NUM_ITEMS
+import asyncio
+import base64
+import hashlib
+import json
+from classifier_pipeline import columnar, merge
+from classifier_pipeline.cache import ResponseCache
+from classifier_pipeline.compression import CompressionMiddleware
+from classifier_pipeline.db import AsyncDb, META_TABLE, MAX_DATE, MIN_DATE, MAX_NUM_ITEMS
 from loguru import logger
 from enum import Enum
 import csv
@@ -15,7 +23,33 @@ from io import StringIO
 ####################################################
 
 app = FastAPI()
+app.add_middleware(CompressionMiddleware)
 date_regex = r'^\d{4}-\d{2}-\d{2}$'
+CSV_CHUNK_ROWS = 1000
+JSON_CHUNK_ITEMS = 100
+CHANGES_HEARTBEAT_SECONDS = 15
+STATS_BINS = 10
+MERGE_FIELDS = ['pmid', 'doi', 'pub_date', 'last_updated', 'merge']
+# fields that can be selected, with those that can be selected within them (by 'field.nested')
+DOCUMENT_FIELDS: Dict[str, List[str]] = {
+    'id': [],
+    'pmid': [],
+    'pmc': [],
+    'doi': [],
+    'title': [],
+    'abstract': [],
+    'author_list': ['fore_name', 'last_name', 'initials', 'collective_name', 'orcid', 'affiliations', 'emails'],
+    'journal': ['title', 'issn', 'volume', 'issue', 'pub_year', 'pub_month', 'pub_day', 'iso_abbreviation'],
+    'publication_type_list': [],
+    'correspondence': [],
+    'mesh_list': [],
+    'classification': [],
+    'probability': [],
+    'pub_date': [],
+    'last_updated': [],
+    'model_version': [],
+    'merge': ['articleCitation', 'authorName', 'emailRecipientAddress'],
+}
 
 
 class RetTypeEnum(str, Enum):
@@ -25,7 +59,10 @@ class RetTypeEnum(str, Enum):
 
 class RetModeEnum(str, Enum):
     json = 'json'
+    ndjson = 'ndjson'
     csv = 'csv'
+    arrow = 'arrow'
+    parquet = 'parquet'
 
 
 ####################################################
@@ -44,6 +81,76 @@ def to_date(input: str):
         return output
 
 
+def to_cursor(item: Dict[str, Any]) -> Optional[str]:
+    """Encode the position after the item as an opaque continuation token"""
+    if item.get('pub_date') is None:
+        return None
+    key = json.dumps([item['pub_date'].isoformat(), item['id']])
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+
+def from_cursor(token: str) -> Tuple[datetime, str]:
+    """Decode a continuation token to the (pub_date, id) it follows"""
+    try:
+        pub_date, id = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+        return datetime.fromisoformat(pub_date), id
+    except (ValueError, TypeError):
+        logger.error('Invalid cursor: {token}', token=token)
+        raise HTTPException(status_code=400, detail=f'Invalid cursor: {token}')
+
+
+def to_fields(fields: str) -> List[str]:
+    """Parse a comma-separated list of field names, each top-level or nested (e.g. 'journal.title')"""
+    parsed = set()
+    for field in fields.split(','):
+        field = field.strip()
+        if not field:
+            continue
+        name, _, nested = field.partition('.')
+        if name not in DOCUMENT_FIELDS or (nested and nested not in DOCUMENT_FIELDS[name]):
+            logger.error('Invalid field: {field}', field=field)
+            raise HTTPException(status_code=400, detail=f'Invalid field: {field}')
+        parsed.add(field)
+    return sorted(parsed)
+
+
+def _project_fields(fields: List[str]) -> Callable[[Any], Any]:
+    """Pluck the fields from documents; a nested field is ignored if the field it's within is selected"""
+    top = [field for field in fields if '.' not in field]
+    nested: Dict[str, List[str]] = {}
+    for field in fields:
+        name, _, within = field.partition('.')
+        if within and name not in top:
+            nested.setdefault(name, []).append(within)
+    selector = top + ([nested] if nested else [])
+
+    def _project(doc: Any) -> Any:
+        return doc.pluck(*selector)
+
+    return _project
+
+
+class Selection(NamedTuple):
+    """The date ranges and position specified for the feed"""
+
+    last_updated_start: datetime
+    last_updated_end: datetime
+    start_date: datetime
+    end_date: datetime
+    after: Optional[Tuple[datetime, str]]
+
+
+def to_selection(start: str, end: str, pubstart: str, pubend: str, cursor: Optional[str] = None) -> Selection:
+    """Parse the request parameters, before any response is started"""
+    return Selection(
+        last_updated_start=to_date(start),
+        last_updated_end=to_date(end),
+        start_date=to_date(pubstart),
+        end_date=to_date(pubend),
+        after=from_cursor(cursor) if cursor is not None else None,
+    )
+
+
 ####################################################
 #                  Database
 ####################################################
@@ -55,8 +162,53 @@ DB_PORT = '28015'
 DB_USERNAME = 'admin'
 DB_PASSWORD = ''
 DB_TABLE = 'documents'
-database = Db(host=DB_HOST, port=DB_PORT, username=DB_USERNAME, password=DB_PASSWORD)
-r, conn, db, table = database.access_table(table_name=DB_TABLE)
+DB_MAX_CONNECTIONS = 10
+database = AsyncDb(
+    host=DB_HOST, port=DB_PORT, user=DB_USERNAME, password=DB_PASSWORD, max_connections=DB_MAX_CONNECTIONS
+)
+DB_INDEXES = {
+    'last_updated': None,
+    'pub_date': None,
+    # compound, to order documents with equal pub_date consistently
+    'pub_date_id': ['pub_date', 'id'],
+}
+r = database.r
+table = database.table(DB_TABLE)
+CACHE_TTL = 60
+GENERATION_RETRY_SECONDS = 10
+response_cache = ResponseCache(ttl=CACHE_TTL)
+
+
+async def _watch_generation():
+    """Follow the generation of the documents, so that cached responses are dropped when they're written"""
+    while True:
+        try:
+            async for generation, modified in database.generations(DB_TABLE):
+                response_cache.set_generation(generation, modified)
+        except Exception as e:
+            logger.warning('Lost the documents generation: {e}', e=e)
+        # serve uncached until the generation is known again
+        response_cache.set_generation(None)
+        await asyncio.sleep(GENERATION_RETRY_SECONDS)
+
+
+@app.on_event('startup')
+async def startup():
+    await database.guarantee_table(DB_TABLE)
+    await database.guarantee_table(META_TABLE)
+    for index_name, fields in DB_INDEXES.items():
+        await database.guarantee_index(table_name=DB_TABLE, index_name=index_name, fields=fields)
+    app.state.generation_watcher = asyncio.create_task(_watch_generation())
+
+
+@app.on_event('shutdown')
+async def shutdown():
+    app.state.generation_watcher.cancel()
+    try:
+        await app.state.generation_watcher
+    except asyncio.CancelledError:
+        pass
+    await database.close()
 
 
 ####################################################
@@ -64,139 +216,413 @@ r, conn, db, table = database.access_table(table_name=DB_TABLE)
 ####################################################
 
 
-def load(start: str, end: str, pubstart: str, pubend: str, limit: int, skip: int):
-    """Access the database as specified"""
-    last_updated_start = to_date(start)
-    last_updated_end = to_date(end)
-    start_date = to_date(pubstart)
-    end_date = to_date(pubend)
-    q = table
-    # ---- Select ----
-    # Minimum last updated date
-    q = q.between(last_updated_start, last_updated_end, index='last_updated')
+def _fraction(extent: Any, lower: datetime, upper: datetime) -> float:
+    """Estimate the fraction of the table in [lower, upper) given the index [min, max], assuming uniformity"""
+    if extent is None or None in extent:
+        return 1.0
+    low, high = extent
+    span = (high - low).total_seconds()
+    overlap = (min(upper, high) - max(lower, low)).total_seconds()
+    if span <= 0:
+        return 1.0 if lower <= low < upper else 0.0
+    return min(max(overlap / span, 0.0), 1.0)
+
+
+async def _use_last_updated_index(conn: Any, selection: Selection) -> bool:
+    """Decide whether the last_updated range is more selective than the publication date range"""
+    extents = await r.expr(
+        {
+            index: r.branch(
+                table.is_empty(),
+                None,
+                [table.min(index=index)[index], table.max(index=index)[index]],
+            )
+            for index in ['last_updated', 'pub_date']
+        }
+    ).run(conn)
+    last_updated_fraction = _fraction(
+        extents['last_updated'], selection.last_updated_start, selection.last_updated_end
+    )
+    pub_date_fraction = _fraction(extents['pub_date'], selection.start_date, selection.end_date)
+    return last_updated_fraction < pub_date_fraction
 
-    # ---- Filter ----
-    # Publication date range
-    pubdate_filter = r.row['pub_date'].ge(start_date) & r.row['pub_date'].lt(end_date)
-    docFilters = pubdate_filter
-    q = q.filter(docFilters)
 
-    # ---- Order ----
-    q = q.order_by(r.desc('pub_date'))
+async def plan(selection: Selection) -> bool:
+    """Choose the index to select the documents with, once per request (True for the last updated index)"""
+    async with database.connection() as conn:
+        return await _use_last_updated_index(conn, selection)
 
-    # ---- Limit ----
-    q = q.skip(skip)
-    q = q.limit(limit)
 
-    cursor = q.run(conn)
-    yield from cursor
+def _select(
+    selection: Selection,
+    by_last_updated: bool,
+    ordered: bool = True,
+    through: Optional[Tuple[datetime, str]] = None,
+):
+    """Build the query for the documents as specified, in descending order of [pub_date, id]
+
+    Documents are selected with the last updated index if by_last_updated (see plan), otherwise with the
+    publication date index. Over the publication date index, they are streamed from an index-ordered range scan,
+    so the first rows are returned without the server sorting (and holding) the whole selection.
+    Given a cursor, only documents that follow it in this order are selected, and given through, only those up
+    to and including that position. When the order doesn't matter (e.g. to aggregate), documents selected with
+    the last updated index are left unsorted.
+    """
+    last_updated_start, last_updated_end, start_date, end_date, after = selection
+    last_updated_filter = r.row['last_updated'].ge(last_updated_start) & r.row['last_updated'].lt(last_updated_end)
+    pubdate_filter = r.row['pub_date'].ge(start_date) & r.row['pub_date'].lt(end_date)
+    q = table
+    if by_last_updated:
+        # ---- Select ----
+        # Last updated date range
+        q = q.between(last_updated_start, last_updated_end, index='last_updated')
+
+        # ---- Filter ----
+        # Publication date range, and position
+        q = q.filter(pubdate_filter)
+        if after is not None:
+            q = q.filter(lambda doc: r.expr([doc['pub_date'], doc['id']]).lt(list(after)))
+        if through is not None:
+            q = q.filter(lambda doc: r.expr([doc['pub_date'], doc['id']]).ge(list(through)))
+
+        # ---- Order ----
+        if ordered:
+            q = q.order_by(r.desc('pub_date'), r.desc('id'))
+    else:
+        # ---- Select & Order ----
+        # Publication date range between the positions, read in index order
+        lower = [start_date, r.minval]
+        if through is not None:
+            lower = list(through)
+        upper = [end_date, r.minval]
+        if after is not None and after[0] < end_date:
+            upper = list(after)
+        q = q.between(lower, upper, index='pub_date_id')
+        q = q.order_by(index=r.desc('pub_date_id'))
+
+        # ---- Filter ----
+        # Last updated date range
+        q = q.filter(last_updated_filter)
+
+    return q
+
+
+def _project_merge(doc: Any) -> Any:
+    """Only the fields used in mail-merge, with what's needed to compute them if they weren't stored"""
+    return r.branch(
+        doc.has_fields('merge'),
+        doc.pluck(*MERGE_FIELDS),
+        doc.pluck(*MERGE_FIELDS, *merge.SOURCE_FIELDS),
+    )
 
 
-def _as_merge(items: Generator[Dict[str, Any], None, None]) -> Generator[Dict[str, Any], None, None]:
-    """Format output fields useful in mail-merge"""
+async def load(
+    selection: Selection,
+    limit: int,
+    skip: int,
+    projection: Optional[Callable[[Any], Any]] = None,
+    by_last_updated: bool = False,
+    through: Optional[Tuple[datetime, str]] = None,
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """Access the database as specified, holding a connection from the pool until the results are streamed
 
+    Given through (see page_end), the page ends at that position rather than after limit documents, so its
+    last document is the one the continuation token was made from, even if documents landed in between.
+    """
+    async with database.connection() as conn:
+        q = _select(selection, by_last_updated, through=through)
 
-    def _get_citation(item: Dict[str, Any]):
-        journal = item['journal']
-        full_title = journal['title'] if 'title' in journal else ''
-        abbrev_title = journal['iso_abbreviation'] if 'iso_abbreviation' in journal else None
-        title = abbrev_title if abbrev_title is not None else full_title
-        sep = ', ' if title else ''
-        year = item['pub_date'].year
-        citation = f'{title}{sep}{year}'
-        return citation
+        # ---- Limit ----
+        q = q.skip(skip)
+        if through is None:
+            q = q.limit(limit)
 
-    def _get_author(item: Dict[str, Any]):
-        """Get a useful author
+        # ---- Project ----
+        if projection is not None:
+            q = q.map(projection)
 
-        Retrieve the last listed author with an associated email.
-        Otherwise retrieve the last author, possibly with a correponding email.
-        """
-        author = None
-        emailRecipientAddress = None
-        author_list = item['author_list']  # always exists
-        with_emails = [a for a in author_list if a['emails'] is not None]
-        has_author_email = len(with_emails)
+        results = await q.run(conn)
+        async for item in results:
+            yield item
 
-        if has_author_email:
-            author = with_emails[-1]
-            emailRecipientAddress = author['emails'][-1]
-        else:
-            author = author_list[-1]
 
-        if not emailRecipientAddress:
-            correspondence = item['correspondence']
-            has_correspondence = len(correspondence) > 0
-            if has_correspondence:
-                correspondence_item = correspondence[-1]
-                if 'emails' in correspondence_item and len(correspondence_item['emails']):
-                    emailRecipientAddress = correspondence_item['emails'][-1]
-        return {'emailRecipientAddress': emailRecipientAddress, 'authorName': author['fore_name']}
+async def load_changes(since: Optional[datetime] = None) -> AsyncGenerator[Dict[str, Any], None]:
+    """Stream documents as they are inserted or updated, holding a feed connection until the stream is closed
 
+    Given a date, documents last updated since are streamed first.
+    """
+    if since is None:
+        q = table.changes()
+    else:
+        q = table.between(since, r.maxval, index='last_updated').changes(include_initial=True)
+    # deletions, and updates out of the range, have no new value
+    q = q.filter(lambda change: change['new_val'].ne(None)).map(lambda change: change['new_val'])
+    async with database.feed_connection() as conn:
+        results = await q.run(conn)
+        async for item in results:
+            yield item
+
+
+async def page_end(
+    selection: Selection, limit: int, skip: int, by_last_updated: bool = False
+) -> Optional[Tuple[datetime, str]]:
+    """The [pub_date, id] of the last document of the page specified, read keys only, if the page is full"""
+    if limit == 0:
+        return None
+    async with database.connection() as conn:
+        q = _select(selection, by_last_updated)
+        last = await q.pluck('pub_date', 'id').skip(skip).nth(limit - 1).default(None).run(conn)
+    if last is None or last.get('pub_date') is None:
+        return None
+    return last['pub_date'], last['id']
+
+
+def validators(
+    key: Tuple[Any, ...], generation: Optional[int], modified: Optional[datetime] = None
+) -> Dict[str, str]:
+    """The ETag and Last-Modified headers for the response, from the request and the generation of the documents
+
+    This needs no query, as the generation and the time it was written change whenever the documents are
+    written (see _watch_generation). While the generation is unknown there is no validator, so the response
+    is sent in full; Last-Modified is left out until the time of a write is known.
+    """
+    if generation is None:
+        return {}
+    fingerprint = json.dumps([*key, generation])
+    # weak, as the body may be encoded differently for the same documents
+    headers = {'ETag': f'W/"{hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()[:32]}"'}
+    if modified is not None:
+        headers['Last-Modified'] = format_datetime(modified.astimezone(timezone.utc), usegmt=True)
+    return headers
+
+
+async def aggregate(selection: Selection, bins: int) -> Dict[str, Any]:
+    """Count the documents selected, overall, by probability bin and by month, in a single query"""
+
+    def _bin(doc):
+        # probability 1 falls in the last bin
+        return r.min([doc['probability'].mul(bins).floor(), bins - 1])
+
+    def _month(field):
+        return lambda doc: [doc[field].year(), doc[field].month()]
+
+    async with database.connection() as conn:
+        q = _select(selection, await _use_last_updated_index(conn, selection), ordered=False)
+        return await r.expr(
+            {
+                'count': q.count(),
+                'probability': q.has_fields('probability').group(_bin).count().ungroup(),
+                'pub_date': q.has_fields('pub_date').group(_month('pub_date')).count().ungroup(),
+                'last_updated': q.has_fields('last_updated').group(_month('last_updated')).count().ungroup(),
+            }
+        ).run(conn)
+
+
+def to_stats(aggregates: Dict[str, Any], bins: int) -> Dict[str, Any]:
+    """Format the aggregates, with a row for every probability bin and for every month with documents"""
+    probability = {int(group['group']): group['reduction'] for group in aggregates['probability']}
+    months: Dict[Tuple[int, int], Dict[str, int]] = {}
+    for field in ['pub_date', 'last_updated']:
+        for group in aggregates[field]:
+            year, month = group['group']
+            months.setdefault((year, month), {'pub_date': 0, 'last_updated': 0})[field] = group['reduction']
+    return {
+        'count': aggregates['count'],
+        'probability': [
+            {'lower': index / bins, 'upper': (index + 1) / bins, 'count': probability.get(index, 0)}
+            for index in range(bins)
+        ],
+        'months': [{'month': f'{year:04d}-{month:02d}', **counts} for (year, month), counts in sorted(months.items())],
+    }
+
+
+def _opaque_tag(etag: str) -> str:
+    """The entity tag without the weak indicator, for weak comparison"""
+    etag = etag.strip()
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def not_modified(headers: Dict[str, str], if_none_match: Optional[str], if_modified_since: Optional[str]) -> bool:
+    """Evaluate the conditional request headers against the response headers (If-None-Match takes precedence)"""
+    if if_none_match is not None:
+        etag = headers.get('ETag')
+        tags = {_opaque_tag(tag) for tag in if_none_match.split(',')}
+        return etag is not None and ('*' in tags or _opaque_tag(etag) in tags)
+    if if_modified_since is not None and 'Last-Modified' in headers:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return parsedate_to_datetime(headers['Last-Modified']) <= since
+    return False
+
+
+async def _as_merge(items: AsyncIterator[Dict[str, Any]], dedup: bool = True) -> AsyncGenerator[Dict[str, Any], None]:
+    """Format output fields useful in mail-merge, once per email address if dedup
+
+    The fields are those stored with the document, or computed for documents loaded before they were.
+    Without dedup (e.g. for an endless stream), every document with an email address is formatted.
+    """
     emails = set()
-    for item in items:
-        author = _get_author(item)
-        emailRecipientAddress = author['emailRecipientAddress']
+    async for item in items:
+        fields = item['merge'] if 'merge' in item else merge.merge_fields(item)
+        emailRecipientAddress = fields['emailRecipientAddress']
         if emailRecipientAddress is None or emailRecipientAddress in emails:
             continue
         else:
-            emails.add(emailRecipientAddress)
+            if dedup:
+                emails.add(emailRecipientAddress)
             yield {
                 'pmid': item['pmid'],
                 'doi': item['doi'],
-                'articleCitation': _get_citation(item),
+                'articleCitation': fields['articleCitation'],
                 'pubDate': item['pub_date'],
                 'lastUpdated': item['last_updated'],
-                'authorName': author['authorName'],
+                'authorName': fields['authorName'],
                 'emailRecipientAddress': emailRecipientAddress
             }
 
 
-def to_ret_type(
-    items: Generator[Dict[str, Any], None, None], rettype: RetTypeEnum
-) -> Generator[Dict[str, Any], None, None]:
+async def to_ret_type(
+    items: AsyncIterator[Dict[str, Any]], rettype: RetTypeEnum, dedup: bool = True
+) -> AsyncGenerator[Dict[str, Any], None]:
     """Format by delegating to a specific formatter"""
     typed = items
     if rettype == RetTypeEnum.default:
         pass
     elif rettype == RetTypeEnum.merge:
-        typed = _as_merge(items)
+        typed = _as_merge(items, dedup)
     else:
         raise ValueError(f'Unsupported RetType: {rettype}')
-    yield from typed
+    async for item in typed:
+        yield item
 
 
-def _as_csv(items: Generator[Dict[str, Any], None, None]) -> Generator[Any, None, None]:
+async def _as_csv(items: AsyncIterator[Dict[str, Any]], rows: int = CSV_CHUNK_ROWS) -> AsyncGenerator[str, None]:
     """
-    Create a new csv file that represents generated data.
+    Stream csv that represents generated data, in chunks of (at most) the given number of rows.
     """
-    csvfile = StringIO()
-    first = next(items, None)
+    try:
+        first = await items.__anext__()
+    except StopAsyncIteration:
+        first = None
     if first is not None:
+        csvfile = StringIO()
+
+        def _flush():
+            chunk = csvfile.getvalue()
+            csvfile.seek(0)
+            csvfile.truncate(0)
+            return chunk
+
         fieldnames = list(first.keys())
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
         writer.writeheader()
         writer.writerow(first)
-        writer.writerows(items)
-        csvfile.seek(0)  # need to seek first posittion for readline() to return something
-        yield from (line for line in csvfile)
-    csvfile.close()
-
-
-def to_ret_mode(items: Generator[Dict[str, Any], None, None], retmode: RetModeEnum) -> Generator[Any, None, None]:
-    """Map to particular MIME type"""
-    result = items
+        # send the header and first row without waiting on a full chunk
+        yield _flush()
+        count = 0
+        async for item in items:
+            writer.writerow(item)
+            count += 1
+            if count == rows:
+                yield _flush()
+                count = 0
+        if count:
+            yield _flush()
+        csvfile.close()
+
+
+def _to_json(value: Any) -> Any:
+    """Encode the values the json module doesn't (as jsonable_encoder would)"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+json_encoder = json.JSONEncoder(ensure_ascii=False, allow_nan=False, separators=(',', ':'), default=_to_json)
+
+
+async def _as_json(items: AsyncIterator[Dict[str, Any]], size: int = JSON_CHUNK_ITEMS) -> AsyncGenerator[str, None]:
+    """Stream a JSON array of the items, encoded one at a time and sent in chunks of (at most) size items"""
+    chunk = ['[']
+    count = 0
+    async for item in items:
+        if count:
+            chunk.append(',')
+        chunk.append(json_encoder.encode(item))
+        count += 1
+        if count % size == 0:
+            yield ''.join(chunk)
+            chunk = []
+    chunk.append(']')
+    yield ''.join(chunk)
+
+
+async def _as_ndjson(items: AsyncIterator[Dict[str, Any]], size: int = JSON_CHUNK_ITEMS) -> AsyncGenerator[str, None]:
+    """Stream newline-delimited JSON of the items, sent in chunks of (at most) size items"""
+    chunk = []
+    async for item in items:
+        chunk.append(json_encoder.encode(item) + '\n')
+        if len(chunk) == size:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+async def _as_event_stream(
+    items: AsyncIterator[Dict[str, Any]], heartbeat: float = CHANGES_HEARTBEAT_SECONDS
+) -> AsyncGenerator[str, None]:
+    """Stream server-sent events of the items, with a comment sent when none arrive within heartbeat seconds
+
+    The heartbeat keeps proxies from timing out an idle stream, and surfaces a client that has gone away.
+    """
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(items.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=heartbeat)
+            if not done:
+                yield ': heartbeat\n\n'
+                continue
+            try:
+                item = pending.result()
+            except StopAsyncIteration:
+                break
+            pending = None
+            yield f'data: {json_encoder.encode(item)}\n\n'
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+def to_ret_mode(
+    items: AsyncIterator[Dict[str, Any]], retmode: RetModeEnum, rettype: RetTypeEnum = RetTypeEnum.default
+) -> StreamingResponse:
+    """Map to particular MIME type; the columnar formats have a fixed schema for each rettype"""
+    if retmode in (RetModeEnum.arrow, RetModeEnum.parquet) and not columnar.available():
+        raise HTTPException(status_code=501, detail=f'Unsupported RetMode: {retmode.value} requires pyarrow')
+    columns = columnar.MERGE_COLUMNS if rettype == RetTypeEnum.merge else columnar.DOCUMENT_COLUMNS
     if retmode == RetModeEnum.json:
-        return result
+        return StreamingResponse(_as_json(items), media_type="application/json")
+    elif retmode == RetModeEnum.ndjson:
+        return StreamingResponse(_as_ndjson(items), media_type="application/x-ndjson")
     elif retmode == RetModeEnum.csv:
-        result = _as_csv(items)
-        return StreamingResponse(result, media_type="text/csv")
+        return StreamingResponse(_as_csv(items), media_type="text/csv")
+    elif retmode == RetModeEnum.arrow:
+        return StreamingResponse(columnar.as_arrow(items, columns), media_type="application/vnd.apache.arrow.stream")
+    elif retmode == RetModeEnum.parquet:
+        return StreamingResponse(columnar.as_parquet(items, columns), media_type="application/vnd.apache.parquet")
     else:
         raise ValueError(f'Unsupported RetMode: {retmode}')
 
 
 @app.get('/')
-def feed(
+async def feed(
     start: str = Query(
         title="Last updated start date",
         description="Include all items whose last updated date follows this date",
@@ -244,9 +670,116 @@ def feed(
         title="retmode",
         description="MIME type of the response",
         default=RetModeEnum.json
-    )
+    ),
+    cursor: Optional[str] = Query(
+        title="Cursor",
+        description="Continuation token from the X-Next-Cursor header of the previous page, present when it was full",
+        default=None
+    ),
+    fields: Optional[str] = Query(
+        title="Fields",
+        description="Comma-separated fields to return, top-level or nested (e.g. pmid,title,journal.title)",
+        default=None
+    ),
+    if_none_match: Optional[str] = Header(default=None),
+    if_modified_since: Optional[str] = Header(default=None),
 ):
-    items = load(start, end, pubstart, pubend, limit, skip)
+    selected = to_fields(fields) if fields is not None else None
+    if selected and rettype != RetTypeEnum.default:
+        raise HTTPException(status_code=400, detail='fields is only supported with rettype=default')
+    projected = ','.join(selected) if selected else None
+    key = (start, end, pubstart, pubend, limit, skip, rettype.value, retmode.value, cursor, projected)
+    cached = response_cache.get(key)
+    if cached is not None:
+        if not_modified(cached.headers, if_none_match, if_modified_since):
+            return Response(status_code=304, headers=cached.headers)
+        return Response(content=cached.body, media_type=cached.media_type, headers=cached.headers)
+
+    selection = to_selection(start, end, pubstart, pubend, cursor)
+    headers = validators(key, response_cache.generation, response_cache.modified)
+    if not_modified(headers, if_none_match, if_modified_since):
+        return Response(status_code=304, headers=headers)
+
+    by_last_updated = await plan(selection)
+
+    projection: Optional[Callable[[Any], Any]] = None
+    if rettype == RetTypeEnum.merge:
+        projection = _project_merge
+    elif selected:
+        projection = _project_fields(selected)
+    # the page ends at the document the continuation token is made from
+    through = await page_end(selection, limit, skip, by_last_updated)
+    token = to_cursor({'pub_date': through[0], 'id': through[1]}) if through is not None else None
+    if token is not None:
+        headers['X-Next-Cursor'] = token
+    items = load(selection, limit, skip, projection, by_last_updated, through)
     items = to_ret_type(items, rettype)
-    items = to_ret_mode(items, retmode)
-    return items
+    result = to_ret_mode(items, retmode, rettype)
+    result.headers.update(headers)
+    result.body_iterator = response_cache.tee(key, result.body_iterator, result.media_type, headers)
+    return result
+
+
+@app.get('/changes')
+async def changes(
+    start: Optional[str] = Query(
+        title="Last updated start date",
+        description="Stream all items whose last updated date follows this date before any changes",
+        default=None,
+        regex=date_regex
+    ),
+    rettype: RetTypeEnum = Query(
+        title="rettype",
+        description="Data format to return - default is raw response",
+        default=RetTypeEnum.default
+    ),
+):
+    """Stream documents as server-sent events as they are inserted or updated"""
+    since = to_date(start) if start is not None else None
+    # each event is formatted on its own, so the stream holds no state and later updates are not dropped
+    items = to_ret_type(load_changes(since), rettype, dedup=False)
+    return StreamingResponse(
+        _as_event_stream(items),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+@app.get('/stats')
+async def stats(
+    start: str = Query(
+        title="Last updated start date",
+        description="Include all items whose last updated date follows this date",
+        default=MIN_DATE,
+        regex=date_regex
+    ),
+    end: str = Query(
+        title="Last updated end date",
+        description="Include all items whose last updated date precedes this date",
+        default=MAX_DATE,
+        regex=date_regex
+    ),
+    pubstart: str = Query(
+        title="Start publication date",
+        description="Include all items whose publication date is greater than or equal to this date",
+        default=MIN_DATE,
+        regex=date_regex
+    ),
+    pubend: str = Query(
+        title="End publication date",
+        description="Include all items whose publication date is less than or equal to this date",
+        default=MAX_DATE,
+        regex=date_regex
+    ),
+    bins: int = Query(
+        title="Bins",
+        description="Number of equal-width bins of the probability histogram",
+        default=STATS_BINS,
+        ge=1,
+        le=100
+    ),
+):
+    """Count the items, overall, by probability and per month of publication and of last update"""
+    selection = to_selection(start, end, pubstart, pubend)
+    aggregates = await aggregate(selection, bins)
+    return to_stats(aggregates, bins)
@@ -0,0 +1,53 @@
+from typing import Any, Dict, List, Optional
+
+# document fields the merge fields are computed from
+SOURCE_FIELDS: List[str] = ['journal', 'pub_date', 'author_list', 'correspondence']
+
+
+def get_citation(item: Dict[str, Any]) -> str:
+    """Journal title (abbreviated, when available) and publication year"""
+    journal = item['journal']
+    full_title = journal['title'] if 'title' in journal else ''
+    abbrev_title = journal['iso_abbreviation'] if 'iso_abbreviation' in journal else None
+    title = abbrev_title if abbrev_title is not None else full_title
+    year = str(item['pub_date'].year) if item['pub_date'] is not None else ''
+    return ', '.join(part for part in [title, year] if part)
+
+
+def get_author(item: Dict[str, Any]) -> Dict[str, Optional[str]]:
+    """Get a useful author
+
+    Retrieve the last listed author with an associated email.
+    Otherwise retrieve the last author, possibly with a correponding email.
+    """
+    author = None
+    emailRecipientAddress = None
+    author_list = item['author_list'] or []
+    with_emails = [a for a in author_list if a['emails'] is not None]
+    has_author_email = len(with_emails)
+
+    if has_author_email:
+        author = with_emails[-1]
+        emailRecipientAddress = author['emails'][-1]
+    elif author_list:
+        author = author_list[-1]
+
+    if not emailRecipientAddress:
+        correspondence = item['correspondence'] or []
+        has_correspondence = len(correspondence) > 0
+        if has_correspondence:
+            correspondence_item = correspondence[-1]
+            if 'emails' in correspondence_item and len(correspondence_item['emails']):
+                emailRecipientAddress = correspondence_item['emails'][-1]
+    authorName = author['fore_name'] if author is not None else None
+    return {'emailRecipientAddress': emailRecipientAddress, 'authorName': authorName}
+
+
+def merge_fields(item: Dict[str, Any]) -> Dict[str, Optional[str]]:
+    """The fields of a document useful in mail-merge"""
+    author = get_author(item)
+    return {
+        'articleCitation': get_citation(item),
+        'authorName': author['authorName'],
+        'emailRecipientAddress': author['emailRecipientAddress'],
+    }
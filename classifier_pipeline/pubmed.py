@@ -1,16 +1,22 @@
-from typing import Callable, Generator, List, Dict, Any, Tuple
-from ncbiutils.ncbiutils import PubMedFetch, PubMedDownload
+from typing import Callable, Generator, List, Dict, Any, Tuple, Optional, Union
+from ncbiutils.ncbiutils import PubMedFetch, PubMedDownload, Chunk
 from ncbiutils.pubmedxmlparser import Citation
-from ncbiutils.types import DbEnum
+from ncbiutils.types import DbEnum, DownloadPathEnum
 from pathway_abstract_classifier.pathway_abstract_classifier import Classifier, Prediction
 from . import ftp
 from loguru import logger
 import time
 import re
 from . import db
+from . import merge
+from .cache import FileCache
 import calendar
 import datetime
+import hashlib
+import json
 import pytz
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 
 def unique_list(alist):
@@ -58,18 +64,26 @@ def updatefiles_facts_db_filter(
     port: int = 28015,
     username: str = 'admin',
     password: str = '',
+    yield_facts: bool = False,
 ):
-    """Select filenames that are new (not present in database) and persist"""
+    """Select filenames that are new (not present in database) and persist
+
+    With yield_facts, the facts are yielded rather than the bare filenames.
+    """
     database = db.Db(host=host, port=port, username=username, password=password)
 
     def _updatefiles_facts_db_filter(facts):
-        for fact in facts:
-            db_fact = database.get(table_name=table_name, id=fact['id'])
-            if db_fact is None:
-                # save to db
-                database.set(table_name=table_name, data=fact)
-                # yield the filename
-                yield fact['id']
+        facts = list(facts)
+        ids = [fact['id'] for fact in facts]
+        known = database.get_many(table_name=table_name, ids=ids, fields=['id'])
+        known_ids = set(db_fact['id'] for db_fact in known)
+        new_facts = [fact for fact in facts if fact['id'] not in known_ids]
+        if new_facts:
+            # save to db
+            database.set_many(table_name=table_name, data=new_facts)
+        # yield the filenames
+        for fact in new_facts:
+            yield fact if yield_facts else fact['id']
 
     return _updatefiles_facts_db_filter
 
@@ -122,6 +136,54 @@ def citation_date_filter(
     return _citation_date_filter
 
 
+def content_hash(document: Dict[str, Any]) -> str:
+    """Fingerprint of a citation's content (as dict), to tell a revised record from the one stored"""
+    content = json.dumps(document, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def citation_db_filter(
+    model_version: str,
+    table_name: str = 'documents',
+    size: int = 1000,
+    host: str = 'localhost',
+    port: int = 28015,
+    username: str = 'admin',
+    password: str = '',
+) -> Callable[[Generator[Citation, None, None]], Generator[Citation, None, None]]:
+    """Drop citations already stored in the database by this classifier model_version, unless revised
+
+    A citation is kept when its content differs from the one stored (see content_hash), e.g. a corrected
+    PubMed record in an update file. Citations are checked in batches of size, one query per batch.
+    """
+    database = db.Db(host=host, port=port, username=username, password=password)
+
+    def _check(batch: List[Citation]) -> Generator[Citation, None, None]:
+        ids = [citation.pmid for citation in batch]
+        known = database.get_many(table_name=table_name, ids=ids, fields=['id', 'model_version', 'content_hash'])
+        classified = {doc['id']: doc.get('content_hash') for doc in known if doc.get('model_version') == model_version}
+        skipped = 0
+        for citation in batch:
+            if citation.pmid in classified and classified[citation.pmid] == content_hash(citation.dict()):
+                skipped += 1
+            else:
+                yield citation
+        if skipped:
+            logger.info('Skipping {n} previously classified citations', n=skipped)
+
+    def _citation_db_filter(citations):
+        batch = []
+        for citation in citations:
+            batch.append(citation)
+            if len(batch) == size:
+                yield from _check(batch)
+                batch = []
+        if batch:
+            yield from _check(batch)
+
+    return _citation_db_filter
+
+
 ####################################################
 #                  Transform
 ####################################################
@@ -138,36 +200,207 @@ def updatefiles_content2facts_transformer(
         yield facts
 
 
+def classifier_version(**opts) -> str:
+    """Identify the classifier model and threshold for the options a Classifier is created with"""
+    model_url = opts.get('model_url', Classifier.__fields__['model_url'].default)
+    threshold = opts.get('threshold', Classifier.__fields__['threshold'].default)
+    return f'{model_url}#threshold={threshold}'
+
+
+_worker_classifier: Optional[Classifier] = None
+
+
+def _init_classifier_worker(opts: Dict[str, Any]) -> None:
+    """Load the model once per worker process"""
+    global _worker_classifier
+    _worker_classifier = Classifier(**opts)
+
+
+def _classify(documents: List[Dict[str, Any]]) -> List[Prediction]:
+    """Classify the documents in a worker process"""
+    assert _worker_classifier is not None
+    start = time.time()
+    prediction = list(_worker_classifier.predict(documents))
+    end = time.time()
+    logger.info(
+        'Finished classification of {n} in {elapsed:.3g} seconds',
+        n=len(documents),
+        elapsed=(end - start),
+    )
+    return prediction
+
+
+def classifier_pool(workers: int, **opts) -> ProcessPoolExecutor:
+    """A pool of worker processes, each loading the model (created with opts) once
+
+    Pass it to classification_transformer to share the workers across pipeline runs, and shut it down
+    (or use it as a context manager) once they are done.
+    """
+    if workers < 1:
+        raise ValueError('workers must be positive')
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_classifier_worker, initargs=(opts,))
+
+
 def classification_transformer(
+    workers: int = 0,
+    ordered: bool = True,
+    queue_size: Optional[int] = None,
+    pool: Optional[ProcessPoolExecutor] = None,
     **opts,
 ) -> Callable[[Generator[List[Citation], None, None]], Generator[Prediction, None, None]]:
-    """Filter the chunks of articles based on text content"""
-    classifier = Classifier(**opts)
+    """Filter the chunks of articles based on text content
+
+    With workers > 0, chunks are classified in that many worker processes, each loading the model once.
+    The workers are those of pool (see classifier_pool), kept across runs; without one, a pool is started
+    for each run and shut down when it ends. At most queue_size chunks (default 2 * workers) are queued
+    or in progress at a time. Predictions are yielded in the order of the chunks unless ordered is False,
+    in which case they are yielded as each chunk completes.
+    """
+    if workers < 0:
+        raise ValueError('workers must be non-negative')
+    max_pending = queue_size if queue_size is not None else 2 * workers
+    if workers > 0 and max_pending < 1:
+        raise ValueError('queue_size must be positive')
+
+    if workers == 0:
+        classifier = Classifier(**opts)
+
+        def _classification_transformer(chunks):
+            for chunk in chunks:
+                logger.info('Classifying: {n}', n=len(chunk))
+                start = time.time()
+                prediction = classifier.predict([c.dict() for c in chunk])
+                end = time.time()
+                logger.info(
+                    'Finished classification in {elapsed:.3g} seconds',
+                    elapsed=(end - start),
+                )
+                yield from prediction
+
+        return _classification_transformer
+
+    def _completed(pending):
+        if ordered:
+            yield from pending.popleft().result()
+        else:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in [f for f in pending if f in done]:
+                pending.remove(future)
+                yield from future.result()
+
+    def _classify_in(executor, chunks):
+        pending: deque = deque()
+        try:
+            for chunk in chunks:
+                logger.info('Classifying: {n}', n=len(chunk))
+                pending.append(executor.submit(_classify, [c.dict() for c in chunk]))
+                while len(pending) >= max_pending:
+                    yield from _completed(pending)
+            while pending:
+                yield from _completed(pending)
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _pooled_classification_transformer(chunks):
+        if pool is not None:
+            yield from _classify_in(pool, chunks)
+            return
+        # the workers are shut down when the chunks are exhausted, or the generator is closed or raises
+        with classifier_pool(workers, **opts) as executor:
+            yield from _classify_in(executor, chunks)
+
+    return _pooled_classification_transformer
+
+
+def _parse_updatefile(data: bytes) -> List[Citation]:
+    """Parse the citations from a gzipped PubMed XML file (module-level so it can run in a worker process)"""
+    return PubMedDownload()._parse_response(data)
+
+
+def updatefiles_downloader(
+    workers: int = 1,
+    download_path: DownloadPathEnum = DownloadPathEnum.updatefiles,
+    cache: Optional[FileCache] = None,
+) -> Callable[[Generator[Union[str, Dict[str, str]], None, None]], Generator[Chunk, None, None]]:
+    """Retrieve and parse PubMed files, yielding one Chunk per file in input order
+
+    Items are file names or file facts (see updatefiles_content2facts_transformer).
+    With workers > 1, up to that many files are downloaded concurrently (threads) and parsed concurrently
+    (processes); at most workers files are in flight beyond the one being consumed.
+    When a cache is provided, it is consulted before downloading, keyed by file name and any facts.
+    """
+    if workers < 1:
+        raise ValueError('workers must be positive')
+    pmd = PubMedDownload()
+    url = f'{pmd.base_url}{download_path}'
+
+    def _download(file: str, facts: Optional[Dict[str, str]]) -> Tuple[Optional[Exception], Optional[bytes]]:
+        if cache is not None:
+            data = cache.get(file, facts)
+            if data is not None:
+                logger.info('Retrieved {file} from cache', file=file)
+                return None, data
+        error, response = pmd._request(f'{url}/{file}')
+        data = response.content if not error and response else None
+        if cache is not None and data is not None:
+            cache.put(file, data, facts)
+        return error, data
+
+    def _retrieve(item: Union[str, Dict[str, str]], parse: Callable[[bytes], List[Citation]]) -> Chunk:
+        citations = None
+        file, facts = (item['filename'], item) if isinstance(item, dict) else (item, None)
+        error, data = _download(file, facts)
+        if data is not None:
+            try:
+                citations = parse(data)
+            except Exception as e:
+                error = e
+        return Chunk(error, citations, [file])
 
-    def _classification_transformer(chunks):
-        for chunk in chunks:
-            logger.info('Classifying: {n}', n=len(chunk))
-            start = time.time()
-            prediction = classifier.predict([c.dict() for c in chunk])
-            end = time.time()
-            logger.info(
-                'Finished classification in {elapsed:.3g} seconds',
-                elapsed=(end - start),
-            )
-            yield from prediction
+    def _serial_downloader(files):
+        for file in files:
+            yield _retrieve(file, _parse_updatefile)
 
-    return _classification_transformer
+    def _parallel_downloader(files):
+        with ThreadPoolExecutor(max_workers=workers) as downloads, ProcessPoolExecutor(max_workers=workers) as parsers:
+
+            def _parse(data):
+                return parsers.submit(_parse_updatefile, data).result()
+
+            pending: deque = deque()
+            try:
+                for file in files:
+                    pending.append(downloads.submit(_retrieve, file, _parse))
+                    if len(pending) > workers:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    return _serial_downloader if workers == 1 else _parallel_downloader
 
 
 def pubmed_transformer(
-    type: str = 'fetch', **opts
-) -> Callable[[Generator[str, None, None]], Generator[Citation, None, None]]:
-    """Retrieve the PubMed records"""
-    pmt = PubMedDownload() if type == 'download' else PubMedFetch(**opts)
+    type: str = 'fetch', workers: int = 1, cache: Optional[FileCache] = None, **opts
+) -> Callable[[Generator[Any, None, None]], Generator[Citation, None, None]]:
+    """Retrieve the PubMed records
+
+    For type 'download', items are file names (or facts), workers sets how many files are retrieved at once
+    and cache is an optional local store of downloaded files.
+    """
+    if type == 'download':
+        get_chunks = updatefiles_downloader(workers=workers, cache=cache)
+    else:
+        pmt = PubMedFetch(**opts)
+
+        def get_chunks(items):
+            return pmt.get_citations([item for item in items])
 
     def _pubmed_fetch_transformer(items):
-        item_list = items if type == 'download' else [item for item in items]
-        chunks = pmt.get_citations(item_list)
+        chunks = get_chunks(items)
         for chunk in chunks:
             error, citations, ids = chunk
             if error is not None:
@@ -180,10 +413,13 @@ def pubmed_transformer(
     return _pubmed_fetch_transformer
 
 
-def prediction_db_transformer() -> Callable[
-    [Generator[Prediction, None, None]], Generator[Dict[str, Any], None, None]
-]:
-    """Format prediction so it can be inserted into database"""
+def prediction_db_transformer(
+    model_version: Optional[str] = None,
+) -> Callable[[Generator[Prediction, None, None]], Generator[Dict[str, Any], None, None]]:
+    """Format prediction so it can be inserted into database, recording the classifier model_version
+
+    The content_hash of the citation is stored too, for citation_db_filter to spot revised records.
+    """
     month_names = {month: index for index, month in enumerate(calendar.month_abbr) if month}
 
     def _get_pub_month(journal):
@@ -215,6 +451,7 @@ def prediction_db_transformer() -> Callable[
         for prediction in predictions:
             document, classification, probability = prediction
             pub_date = _get_pub_date(document)
+            fingerprint = content_hash(document)
             document.update(
                 {
                     'id': document['pmid'],
@@ -222,6 +459,8 @@ def prediction_db_transformer() -> Callable[
                     'probability': probability,
                     'pub_date': pub_date,
                     'last_updated': datetime.datetime.now(pytz.UTC),
+                    'model_version': model_version,
+                    'content_hash': fingerprint,
                 }
             )
             yield document
@@ -289,6 +528,17 @@ def pmc_supplement_transfomer() -> Callable[
     return _pmc_supplement_transfomer
 
 
+def merge_transformer() -> Callable[[Generator[Dict[str, Any], None, None]], Generator[Dict[str, Any], None, None]]:
+    """Add the fields used in mail-merge to documents, so they are computed once (see merge.merge_fields)"""
+
+    def _merge_transformer(docs: Generator[Dict[str, Any], None, None]) -> Generator[Dict[str, Any], None, None]:
+        for doc in docs:
+            doc['merge'] = merge.merge_fields(doc)
+            yield doc
+
+    return _merge_transformer
+
+
 ####################################################
 #                  Helpers
 ####################################################
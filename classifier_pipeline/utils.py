@@ -1,5 +1,11 @@
 import csv
-from typing import Dict, List, Callable, Any, Generator, IO
+import json
+import queue
+import threading
+import time
+from typing import Dict, List, Callable, Any, Generator, IO, Optional
+from pydantic import BaseModel, PrivateAttr
+from loguru import logger
 from . import db
 from collections import deque
 
@@ -9,11 +15,156 @@ from collections import deque
 ####################################################
 
 
-def as_pipeline(steps: List[Callable[[Any], Any]]) -> Callable[[Any], Any]:
+class StageStats(BaseModel):
+    """Counts and time spent inside a pipeline stage, excluding time spent waiting on upstream stages"""
+
+    name: str
+    items_in: int = 0
+    items_out: int = 0
+    elapsed: float = 0.0
+    waited: float = 0.0
+
+    @property
+    def seconds(self) -> float:
+        # a stage that pulls upstream in another thread (e.g. prefetch) can wait longer than it runs
+        return max(self.elapsed - self.waited, 0.0)
+
+    @property
+    def rate(self) -> float:
+        return self.items_out / self.seconds if self.seconds > 0 else 0.0
+
+
+class PipelineStats(BaseModel):
+    """
+    Opt-in instrumentation for as_pipeline
+
+    Attributes
+    ----------
+    interval : Optional[float] = 60
+        Seconds between logged snapshots while the pipeline runs (None to disable)
+
+
+    Methods
+    ----------
+    summary() -> str
+        A table of items in/out, seconds spent in and items/second out of each stage
+    log_summary() -> None
+        Log the summary table
+    """
+
+    interval: Optional[float] = 60
+    stages: Dict[str, StageStats] = {}
+
+    _last_snapshot: float = PrivateAttr()
+
+    def __init__(self, **data: Any) -> None:
+        super().__init__(**data)
+        self._last_snapshot = time.perf_counter()
+
+    def stage(self, index: int, name: str) -> StageStats:
+        """Get or create the stats for the stage, so that repeated runs of a pipeline accumulate"""
+        key = f'{index}:{name}'
+        if key not in self.stages:
+            self.stages[key] = StageStats(name=name)
+        return self.stages[key]
+
+    def summary(self) -> str:
+        rows = [f'{"stage":<32} {"in":>10} {"out":>10} {"seconds":>10} {"items/s":>10}']
+        for stage in self.stages.values():
+            rows.append(
+                f'{stage.name:<32} {stage.items_in:>10} {stage.items_out:>10} '
+                f'{stage.seconds:>10.3f} {stage.rate:>10.1f}'
+            )
+        return '\n'.join(rows)
+
+    def log_summary(self) -> None:
+        logger.info('Pipeline stats:\n{summary}', summary=self.summary())
+
+    def tick(self) -> None:
+        """Log a snapshot if the interval has passed"""
+        if self.interval is None:
+            return
+        now = time.perf_counter()
+        if now - self._last_snapshot >= self.interval:
+            self._last_snapshot = now
+            self.log_summary()
+
+
+def _close(iterator) -> None:
+    if hasattr(iterator, 'close'):
+        iterator.close()
+
+
+def _instrument_input(items, stage: StageStats):
+    iterator = iter(items)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                stage.waited += time.perf_counter() - start
+            stage.items_in += 1
+            yield item
+    finally:
+        _close(iterator)
+
+
+def _instrument_output(items, stage: StageStats, stats: PipelineStats, last: bool):
+    iterator = iter(items)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                if last:
+                    stats.log_summary()
+                return
+            finally:
+                stage.elapsed += time.perf_counter() - start
+            stage.items_out += 1
+            stats.tick()
+            yield item
+    finally:
+        _close(iterator)
+
+
+def _stage_name(step: Any) -> str:
+    return getattr(step, '__name__', type(step).__name__).strip('_<>')
+
+
+def as_pipeline(
+    steps: List[Callable[[Any], Any]], stats: Optional[PipelineStats] = None, summary: bool = True
+) -> Callable[[Any], Any]:
+    """Compose the steps, the first being the source of items
+
+    When stats are provided, items and time are recorded for each stage and, unless summary is False
+    (e.g. stats accumulated over several pipelines, logged by the caller), a summary is logged when the
+    pipeline is exhausted.
+    """
     generator = steps.pop(0)
-    for step in steps:
-        generator = step(generator)
-    return generator
+    if stats is None:
+        for step in steps:
+            generator = step(generator)
+        return generator
+
+    source = stats.stage(0, _stage_name(generator))
+    instrumented: Any = _instrument_output(generator, source, stats, last=summary and not steps)
+    for index, step in enumerate(steps, start=1):
+        stage = stats.stage(index, _stage_name(step))
+        start = time.perf_counter()
+        instrumented = step(_instrument_input(instrumented, stage))
+        stage.elapsed += time.perf_counter() - start
+        if instrumented is None:
+            # a sink (e.g. exhaust) that consumed the items
+            if summary:
+                stats.log_summary()
+            break
+        instrumented = _instrument_output(instrumented, stage, stats, last=summary and index == len(steps))
+    return instrumented
 
 
 ####################################################
@@ -93,6 +244,59 @@ def chunker(size: int) -> Callable[[Generator[Any, None, None]], Generator[Any,
     return _chunker
 
 
+def prefetch(size: int) -> Callable[[Generator[Any, None, None]], Generator[Any, None, None]]:
+    """Pull items from upstream in a background thread, buffering up to size items
+
+    Upstream work (e.g. downloading) then overlaps with downstream work (e.g. classification).
+    Exceptions raised upstream are re-raised to the consumer; closing the stage stops the thread.
+    """
+    if size < 1:
+        raise ValueError('size must be positive')
+
+    def _prefetch(items):
+        buffer: queue.Queue = queue.Queue(maxsize=size)
+        stopped = threading.Event()
+
+        def _put(message):
+            while not stopped.is_set():
+                try:
+                    buffer.put(message, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def _produce():
+            try:
+                for item in items:
+                    if not _put((True, item)):
+                        break
+                else:
+                    _put((False, None))
+            except BaseException as e:
+                _put((False, e))
+            finally:
+                if hasattr(items, 'close'):
+                    items.close()
+
+        producer = threading.Thread(target=_produce, name='prefetch', daemon=True)
+        producer.start()
+        try:
+            while True:
+                is_item, value = buffer.get()
+                if is_item:
+                    yield value
+                elif value is not None:
+                    raise value
+                else:
+                    break
+        finally:
+            stopped.set()
+            producer.join()
+
+    return _prefetch
+
+
 def list_transformer(field: str) -> Callable[[Generator[Any, None, None]], Generator[Any, None, None]]:
     """Create a list from a field"""
 
@@ -108,15 +312,62 @@ def list_transformer(field: str) -> Callable[[Generator[Any, None, None]], Gener
 ####################################################
 
 
+def _sizeof(item: Any) -> int:
+    """Approximate size in bytes of the serialized item"""
+    return len(json.dumps(item, default=str).encode('utf-8'))
+
+
+def _batches(items, size: int, max_bytes: Optional[int] = None):
+    """Aggregate items into lists bounded by count and, optionally, serialized size in bytes"""
+    batch: List[Any] = []
+    batch_bytes = 0
+    for item in items:
+        item_bytes = _sizeof(item) if max_bytes is not None else 0
+        if batch and max_bytes is not None and batch_bytes + item_bytes > max_bytes:
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(item)
+        batch_bytes += item_bytes
+        if len(batch) == size:
+            yield batch
+            batch = []
+            batch_bytes = 0
+    if batch:
+        yield batch
+
+
 def db_loader(
-    table_name: str, host: str = 'localhost', port: int = 28015, username: str = 'admin', password: str = ''
+    table_name: str,
+    host: str = 'localhost',
+    port: int = 28015,
+    username: str = 'admin',
+    password: str = '',
+    batch_size: int = 1,
+    max_bytes: Optional[int] = None,
 ):
-    """Insert (or replace) items in the named database table"""
+    """Insert (or replace) items in the named database table
+
+    Items are sent in batches of at most batch_size items (and max_bytes of serialized JSON, when set),
+    one query per batch; the status flags yielded for each batch are summed over its items.
+    Each batch that changes the table increments its generation, so readers can drop what they've cached.
+    """
+    if batch_size < 1:
+        raise ValueError('batch_size must be positive')
     database = db.Db(host=host, port=port, username=username, password=password)
 
+    def _changed(result: Dict[str, int]) -> Dict[str, int]:
+        if any(result.get(flag) for flag in ['inserted', 'replaced', 'deleted']):
+            database.increment_generation(table_name)
+        return result
+
     def _db_loader(items):
-        for item in items:
-            yield database.set(table_name, item)
+        if batch_size == 1 and max_bytes is None:
+            for item in items:
+                yield _changed(database.set(table_name, item))
+        else:
+            for batch in _batches(items, batch_size, max_bytes):
+                yield _changed(database.set_many(table_name, batch))
 
     return _db_loader
 
@@ -1,17 +1,22 @@
 from loguru import logger
 import argparse
-from classifier_pipeline.utils import as_pipeline, chunker, db_loader, filter, exhaust
+from classifier_pipeline.cache import FileCache
+from classifier_pipeline.checkpoint import Checkpoint, FileStateEnum, checkpoint_filter
+from classifier_pipeline.utils import as_pipeline, chunker, db_loader, filter, exhaust, prefetch, PipelineStats
 from classifier_pipeline.pubmed import (
     updatefiles_extractor,
     updatefiles_data_filter,
     updatefiles_content2facts_transformer,
-    updatefiles_facts_db_filter,
-    pubmed_transformer,
+    updatefiles_downloader,
     citation_pubtype_filter,
     classification_transformer,
+    classifier_pool,
     prediction_db_transformer,
     citation_date_filter,
+    citation_db_filter,
+    classifier_version,
     pmc_supplement_transfomer,
+    merge_transformer,
     prediction_print_spy,
 )
 
@@ -31,7 +36,12 @@ logger.add("cron_{time}.log")
 parser = argparse.ArgumentParser()
 parser.add_argument('--threshold', nargs='?', type=float, default=str(0.990))
 parser.add_argument('--table', nargs='?', type=str, default='documents')
+parser.add_argument('--workers', nargs='?', type=int, default=str(0))
+parser.add_argument('--stats', nargs='?', type=float, default=None)
 parser.add_argument('--minyear', nargs='?', type=int, default=str(2021))
+parser.add_argument('--downloads', nargs='?', type=int, default=str(1))
+parser.add_argument('--cachedir', nargs='?', type=str, default=None)
+parser.add_argument('--cachesize', nargs='?', type=int, default=str(20))
 
 
 def get_opts():
@@ -40,12 +50,115 @@ def get_opts():
         'threshold': args.threshold,
         'table': args.table,
         'minyear': args.minyear,
+        'workers': args.workers,
+        'stats': args.stats,
+        'downloads': args.downloads,
+        'cachedir': args.cachedir,
+        'cachesize': args.cachesize,
     }
     if opts['threshold'] < 0 or opts['threshold'] > 1:
         raise ValueError('threshold must be on [0, 1]')
+    if opts['workers'] < 0:
+        raise ValueError('workers must be non-negative')
+    if opts['downloads'] < 1:
+        raise ValueError('downloads must be positive')
+    if opts['cachesize'] < 0:
+        raise ValueError('cachesize (GiB) must be non-negative')
     return opts
 
 
+####################################################
+#                  Run
+####################################################
+
+
+def run(opts):
+    """Process each new update file, checkpointing its state so an interrupted run resumes where it stopped
+
+    Files are 'listed' when first seen, 'downloaded', 'classified' (positive documents are kept with the
+    checkpoint) and finally 'loaded'. Files that failed to download remain pending for the next run.
+    """
+    cache = None
+    if opts['cachedir'] is not None:
+        cache = FileCache(path=opts['cachedir'], max_bytes=opts['cachesize'] * 1024**3)
+    checkpoint = Checkpoint()
+    # per-stage stats accumulate over files (snapshot interval in seconds, if enabled)
+    classify_stats = PipelineStats(interval=opts['stats']) if opts['stats'] is not None else None
+    load_stats = PipelineStats(interval=opts['stats']) if opts['stats'] is not None else None
+    model_version = classifier_version(threshold=opts['threshold'])
+    # shared by the runs over each file, and shut down at the end
+    pool = classifier_pool(opts['workers'], threshold=opts['threshold']) if opts['workers'] > 0 else None
+
+    # Per-file stages, created once (e.g. the classifier model is loaded once)
+    classify = [
+        filter(lambda x: x.author_list is not None),
+        citation_pubtype_filter,
+        citation_date_filter(opts['minyear']),
+        citation_db_filter(model_version=model_version, table_name=opts['table']),
+        chunker(1000),
+        classification_transformer(workers=opts['workers'], pool=pool, threshold=opts['threshold']),
+        prediction_print_spy,
+        filter(lambda x: x.classification == 1),
+        prediction_db_transformer(model_version=model_version),
+        chunker(100),
+        pmc_supplement_transfomer(),
+        merge_transformer(),
+    ]
+    load = [
+        db_loader(table_name=opts['table'], batch_size=100),
+        exhaust,
+    ]
+
+    try:
+        pending = list(
+            as_pipeline(
+                [
+                    updatefiles_extractor(),
+                    updatefiles_data_filter(),
+                    updatefiles_content2facts_transformer,
+                    checkpoint_filter(checkpoint),
+                ]
+            )
+        )
+
+        # Classified in a previous run, but not loaded
+        for facts in [f for f in pending if f['state'] == FileStateEnum.classified]:
+            filename = facts['id']
+            documents = checkpoint.documents(filename)
+            as_pipeline([(d for d in documents)] + load, stats=load_stats, summary=False)
+            checkpoint.mark(filename, FileStateEnum.loaded)
+
+        to_download = (f for f in pending if f['state'] in (FileStateEnum.listed, FileStateEnum.downloaded))
+        # retrieve the next file while the current one is classified
+        chunks = as_pipeline(
+            [
+                to_download,
+                updatefiles_downloader(workers=opts['downloads'], cache=cache),
+                prefetch(1),
+            ]
+        )
+        for chunk in chunks:
+            error, citations, ids = chunk
+            filename = ids[0]
+            if error is not None:
+                logger.error('Error retrieving {filename}: {error}', filename=filename, error=error)
+                continue
+            logger.info('Downloaded {n} citations', n=len(citations))
+            checkpoint.mark(filename, FileStateEnum.downloaded)
+            documents = list(as_pipeline([(c for c in citations)] + classify, stats=classify_stats, summary=False))
+            checkpoint.mark(filename, FileStateEnum.classified, documents=documents)
+            as_pipeline([(d for d in documents)] + load, stats=load_stats, summary=False)
+            checkpoint.mark(filename, FileStateEnum.loaded)
+
+        # totals over all files
+        for stats in (classify_stats, load_stats):
+            if stats is not None:
+                stats.log_summary()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
 ####################################################
 #                 __main__
 ####################################################
@@ -53,24 +166,4 @@ def get_opts():
 if __name__ == '__main__':
     opts = get_opts()
     logger.info('Run config: {opts}', opts=opts)
-    pipeline = as_pipeline(
-        [
-            updatefiles_extractor(),
-            updatefiles_data_filter(),
-            updatefiles_content2facts_transformer,
-            updatefiles_facts_db_filter(),
-            pubmed_transformer(type='download'),
-            filter(lambda x: x.author_list is not None),
-            citation_pubtype_filter,
-            citation_date_filter(opts['minyear']),
-            chunker(1000),
-            classification_transformer(threshold=opts['threshold']),
-            prediction_print_spy,
-            filter(lambda x: x.classification == 1),
-            prediction_db_transformer(),
-            chunker(100),
-            pmc_supplement_transfomer(),
-            db_loader(table_name=opts['table']),
-            exhaust,
-        ]
-    )
+    run(opts)
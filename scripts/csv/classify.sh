@@ -42,6 +42,9 @@ fi
 if [ ${ARG_MINYEAR} ]; then
     PIPELINE_ARGS+=" --minyear ${ARG_MINYEAR}"
 fi
+if [ ${ARG_WORKERS} ]; then
+    PIPELINE_ARGS+=" --workers ${ARG_WORKERS}"
+fi
 
 echo "Starting new screen session..."
 echo "PIPELINE_ARGS: ${PIPELINE_ARGS}"
@@ -4,11 +4,13 @@ import argparse
 from collections import deque
 from classifier_pipeline.utils import (
     as_pipeline,
+    PipelineStats,
     csv2dict_reader,
     list_transformer,
     chunker,
     db_loader,
     filter,
+    prefetch,
 )
 from classifier_pipeline.pubmed import (
     pubmed_transformer,
@@ -16,7 +18,10 @@ from classifier_pipeline.pubmed import (
     classification_transformer,
     prediction_db_transformer,
     citation_date_filter,
+    citation_db_filter,
+    classifier_version,
     pmc_supplement_transfomer,
+    merge_transformer,
 )
 
 
@@ -32,6 +37,8 @@ parser.add_argument('--threshold', nargs='?', type=float, default=str(default_th
 parser.add_argument('--type', nargs='?', type=str, default='fetch')
 parser.add_argument('--idcolumn', nargs='?', type=str, default='pmid')
 parser.add_argument('--table', nargs='?', type=str, default='articles')
+parser.add_argument('--workers', nargs='?', type=int, default=str(0))
+parser.add_argument('--stats', nargs='?', type=float, default=None)
 parser.add_argument('--minyear', nargs='?', type=int, default=str(default_min_year))
 
 
@@ -44,6 +51,8 @@ def get_opts():
         'idcolumn': args.idcolumn,
         'table': args.table,
         'minyear': args.minyear,
+        'workers': args.workers,
+        'stats': args.stats,
     }
 
     if opts['retmax'] < 0:
@@ -53,6 +62,8 @@ def get_opts():
 
     if opts['threshold'] < 0 or opts['threshold'] > 1:
         raise ValueError('threshold must be on [0, 1]')
+    if opts['workers'] < 0:
+        raise ValueError('workers must be non-negative')
 
     return opts
 
@@ -95,23 +106,28 @@ def prediction_print_spy(predictions):
 if __name__ == '__main__':
     opts = get_opts()
     print(opts)
+    model_version = classifier_version(threshold=opts['threshold'])
 
     pipeline = as_pipeline(
         [
             csv2dict_reader(sys.stdin),
             list_transformer(field=opts['idcolumn']),
             pubmed_transformer(type=opts['type']),
+            prefetch(retmax_limit),
             filter(lambda x: x.author_list is not None),
             citation_pubtype_filter,
             citation_date_filter(opts['minyear']),
+            citation_db_filter(model_version=model_version, table_name=opts['table']),
             chunker(1000),
-            classification_transformer(threshold=opts['threshold']),
+            classification_transformer(workers=opts['workers'], threshold=opts['threshold']),
             prediction_print_spy,
             filter(lambda x: x.classification == 1),
-            prediction_db_transformer(),
+            prediction_db_transformer(model_version=model_version),
             chunker(1000),
             pmc_supplement_transfomer(),
-            db_loader(table_name=opts['table']),
+            merge_transformer(),
+            db_loader(table_name=opts['table'], batch_size=100),
             exhaust,
-        ]
+        ],
+        stats=PipelineStats(interval=opts['stats']) if opts['stats'] is not None else None,
     )
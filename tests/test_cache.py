@@ -0,0 +1,117 @@
+import asyncio
+import os
+import datetime
+from classifier_pipeline.cache import CachedResponse, FileCache, ResponseCache
+
+FACTS = {'modify': '20211213192136', 'size': '5'}
+
+
+def test_cache_put_get(tmp_path):
+    cache = FileCache(path=str(tmp_path))
+    assert cache.get('a.xml.gz', FACTS) is None
+    cache.put('a.xml.gz', b'12345', FACTS)
+    assert cache.get('a.xml.gz', FACTS) == b'12345'
+
+
+def test_cache_keyed_by_facts(tmp_path):
+    cache = FileCache(path=str(tmp_path))
+    cache.put('a.xml.gz', b'12345', FACTS)
+    assert cache.get('a.xml.gz', {'modify': '20221213192136', 'size': '5'}) is None
+    assert cache.get('a.xml.gz') is None
+
+
+def test_cache_discards_size_mismatch(tmp_path):
+    cache = FileCache(path=str(tmp_path))
+    cache.put('a.xml.gz', b'123', FACTS)
+    assert cache.get('a.xml.gz', FACTS) is None
+    assert len(os.listdir(tmp_path)) == 0
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = FileCache(path=str(tmp_path), max_bytes=10)
+    cache.put('a.xml.gz', b'12345', FACTS)
+    cache.put('b.xml.gz', b'12345', FACTS)
+    os.utime(tmp_path / cache._key('a.xml.gz', FACTS), (1, 1))
+    os.utime(tmp_path / cache._key('b.xml.gz', FACTS), (2, 2))
+    # reading 'a' marks it as most recently used, so 'b' is evicted next
+    assert cache.get('a.xml.gz', FACTS) is not None
+    cache.put('c.xml.gz', b'12345', FACTS)
+    assert cache.get('a.xml.gz', FACTS) is not None
+    assert cache.get('b.xml.gz', FACTS) is None
+    assert cache.get('c.xml.gz', FACTS) is not None
+
+
+def _response(body: bytes) -> CachedResponse:
+    return CachedResponse(body, 'application/json', {})
+
+
+def test_response_cache_requires_generation():
+    cache = ResponseCache()
+    cache.put('a', _response(b'[]'), None)
+    assert cache.get('a') is None
+    cache.set_generation(1)
+    cache.put('a', _response(b'[]'), 1)
+    assert cache.get('a').body == b'[]'
+
+
+def test_response_cache_generation_change():
+    cache = ResponseCache()
+    cache.set_generation(1)
+    cache.put('a', _response(b'[]'), 1)
+    cache.set_generation(2)
+    assert cache.get('a') is None
+    assert cache.generation == 2
+    assert cache.modified is None
+    # read in the previous generation
+    cache.put('a', _response(b'[]'), 1)
+    assert cache.get('a') is None
+
+
+def test_response_cache_modified():
+    cache = ResponseCache()
+    modified = datetime.datetime(2022, 5, 24, tzinfo=datetime.timezone.utc)
+    cache.set_generation(1, modified)
+    assert cache.modified == modified
+    cache.set_generation(None, modified)
+    assert cache.generation is None and cache.modified is None
+
+
+def test_response_cache_ttl(mocker):
+    cache = ResponseCache(ttl=10)
+    cache.set_generation(1)
+    monotonic = mocker.patch('classifier_pipeline.cache.time.monotonic', return_value=0)
+    cache.put('a', _response(b'[]'), 1)
+    monotonic.return_value = 5
+    assert cache.get('a') is not None
+    monotonic.return_value = 10
+    assert cache.get('a') is None
+
+
+def test_response_cache_evicts_least_recently_used():
+    cache = ResponseCache(max_bytes=10)
+    cache.set_generation(1)
+    cache.put('a', _response(b'12345'), 1)
+    cache.put('b', _response(b'12345'), 1)
+    assert cache.get('a') is not None
+    cache.put('c', _response(b'12345'), 1)
+    assert cache.get('a') is not None
+    assert cache.get('b') is None
+    assert cache.get('c') is not None
+
+
+def test_response_cache_tee():
+    cache = ResponseCache(max_entry_bytes=4)
+    cache.set_generation(1)
+
+    async def _chunks(chunks):
+        for chunk in chunks:
+            yield chunk
+
+    async def _stream(key, chunks):
+        return [chunk async for chunk in cache.tee(key, _chunks(chunks), 'text/csv', {'ETag': 'W/"1"'})]
+
+    assert asyncio.run(_stream('a', ['12', '34'])) == ['12', '34']
+    assert cache.get('a') == CachedResponse(b'1234', 'text/csv', {'ETag': 'W/"1"'})
+    # too large to cache
+    assert asyncio.run(_stream('b', ['12', '345'])) == ['12', '345']
+    assert cache.get('b') is None
@@ -0,0 +1,50 @@
+from classifier_pipeline.checkpoint import Checkpoint, FileStateEnum, checkpoint_filter
+
+
+def as_facts(names):
+    return [{'id': name, 'filename': name} for name in names]
+
+
+def test_checkpoint_resume(mocker):
+    known = [
+        {'id': 'a.xml.gz', 'state': 'loaded'},
+        {'id': 'b.xml.gz', 'state': 'classified'},
+        {'id': 'c.xml.gz', 'state': 'downloaded'},
+        {'id': 'd.xml.gz'},
+    ]
+    mocker.patch('classifier_pipeline.checkpoint.db.Db.get_many', return_value=known)
+    set_many = mocker.patch('classifier_pipeline.checkpoint.db.Db.set_many')
+    facts = as_facts(['a.xml.gz', 'b.xml.gz', 'c.xml.gz', 'd.xml.gz', 'e.xml.gz'])
+    pending = Checkpoint().resume(facts)
+    assert [(f['id'], f['state']) for f in pending] == [
+        ('b.xml.gz', FileStateEnum.classified),
+        ('c.xml.gz', FileStateEnum.downloaded),
+        ('e.xml.gz', FileStateEnum.listed),
+    ]
+    set_many.assert_called_once()
+    _, kwargs = set_many.call_args
+    assert [f['id'] for f in kwargs['data']] == ['e.xml.gz']
+
+
+def test_checkpoint_filter(mocker):
+    mocker.patch('classifier_pipeline.checkpoint.db.Db.get_many', return_value=[])
+    mocker.patch('classifier_pipeline.checkpoint.db.Db.set_many')
+    facts = as_facts(['a.xml.gz', 'b.xml.gz'])
+    pending = list(checkpoint_filter(Checkpoint())(f for f in facts))
+    assert [f['id'] for f in pending] == ['a.xml.gz', 'b.xml.gz']
+    assert all(f['state'] == FileStateEnum.listed for f in pending)
+
+
+def test_checkpoint_mark(mocker):
+    update = mocker.patch('classifier_pipeline.checkpoint.db.Db.update')
+    documents = [{'id': '1'}]
+    Checkpoint().mark('a.xml.gz', FileStateEnum.classified, documents=documents)
+    _, kwargs = update.call_args
+    assert kwargs['id'] == 'a.xml.gz'
+    assert kwargs['data']['state'] == FileStateEnum.classified
+    assert kwargs['data']['documents'] == documents
+
+
+def test_checkpoint_documents(mocker):
+    mocker.patch('classifier_pipeline.checkpoint.db.Db.get', return_value={'id': 'a.xml.gz', 'documents': None})
+    assert Checkpoint().documents('a.xml.gz') == []
@@ -0,0 +1,69 @@
+import asyncio
+import io
+import pytest
+from datetime import datetime
+import pytz
+from classifier_pipeline import columnar
+
+pyarrow = pytest.importorskip('pyarrow')
+pq = pytest.importorskip('pyarrow.parquet')
+
+PUB_DATE = datetime(2022, 5, 24, tzinfo=pytz.UTC)
+
+
+@pytest.fixture
+def documents():
+    return [
+        {
+            'pmid': str(i),
+            'doi': None,
+            'title': f'Title {i}',
+            'journal': {'title': 'Journal of Things'},
+            'classification': 1,
+            'probability': 0.9,
+            'pub_date': PUB_DATE,
+            'last_updated': PUB_DATE,
+        }
+        for i in range(5)
+    ]
+
+
+async def _aiter(items):
+    for item in items:
+        yield item
+
+
+def _collect(chunks):
+    async def _join():
+        return b''.join([chunk async for chunk in chunks])
+
+    return asyncio.run(_join())
+
+
+def test_as_arrow(documents):
+    data = _collect(columnar.as_arrow(_aiter(documents), columnar.DOCUMENT_COLUMNS, rows=2))
+    reader = pyarrow.ipc.open_stream(data)
+    batches = list(reader)
+    assert [batch.num_rows for batch in batches] == [2, 2, 1]
+    table = pyarrow.Table.from_batches(batches)
+    assert table.schema == columnar.to_schema(columnar.DOCUMENT_COLUMNS)
+    assert table.column('pmid').to_pylist() == ['0', '1', '2', '3', '4']
+    assert table.column('journal').to_pylist()[0] == 'Journal of Things'
+    assert table.column('abstract').to_pylist()[0] is None
+    assert table.column('pub_date').to_pylist()[0] == PUB_DATE
+
+
+def test_as_arrow_empty():
+    data = _collect(columnar.as_arrow(_aiter([]), columnar.MERGE_COLUMNS))
+    table = pyarrow.ipc.open_stream(data).read_all()
+    assert table.num_rows == 0
+    assert table.schema.names[0] == 'pmid'
+
+
+def test_as_parquet(documents):
+    data = _collect(columnar.as_parquet(_aiter(documents), columnar.DOCUMENT_COLUMNS, rows=2))
+    parquet_file = pq.ParquetFile(io.BytesIO(data))
+    assert parquet_file.metadata.num_row_groups == 3
+    table = parquet_file.read()
+    assert table.column('title').to_pylist() == [f'Title {i}' for i in range(5)]
+    assert table.column('probability').to_pylist() == [0.9] * 5
@@ -0,0 +1,130 @@
+import asyncio
+import gzip
+import zlib
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi.testclient import TestClient
+from classifier_pipeline.compression import CompressionMiddleware, negotiate
+
+CHUNK = 'pmid,title\n' * 100
+
+
+@pytest.fixture
+def app():
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware)
+
+    async def _chunks():
+        for _ in range(3):
+            yield CHUNK
+
+    @app.get('/stream')
+    async def stream():
+        return StreamingResponse(_chunks(), media_type='text/csv')
+
+    @app.get('/small')
+    async def small():
+        return PlainTextResponse('small')
+
+    @app.get('/large')
+    async def large():
+        return PlainTextResponse(CHUNK)
+
+    return app
+
+
+def test_negotiate():
+    assert negotiate('gzip, deflate', ['zstd', 'gzip']) == 'gzip'
+    assert negotiate('gzip;q=0.5, zstd', ['zstd', 'gzip']) == 'zstd'
+    assert negotiate('zstd;q=0, gzip', ['zstd', 'gzip']) == 'gzip'
+    assert negotiate('*', ['zstd', 'gzip']) == 'zstd'
+    assert negotiate('*;q=0, gzip', ['zstd', 'gzip']) == 'gzip'
+    assert negotiate('identity', ['zstd', 'gzip']) is None
+    assert negotiate('', ['zstd', 'gzip']) is None
+
+
+def test_compresses_stream(app):
+    client = TestClient(app)
+    response = client.get('/stream', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['content-encoding'] == 'gzip'
+    assert 'content-length' not in response.headers
+    assert 'Accept-Encoding' in response.headers['vary']
+    assert response.text == CHUNK * 3
+
+
+def test_compresses_whole_body(app):
+    client = TestClient(app)
+    response = client.get('/large', headers={'Accept-Encoding': 'gzip'}, stream=True)
+    raw = response.raw.read(decode_content=False)
+    assert response.headers['content-encoding'] == 'gzip'
+    assert int(response.headers['content-length']) == len(raw)
+    assert gzip.decompress(raw).decode('utf-8') == CHUNK
+
+
+def test_passthrough(app):
+    client = TestClient(app)
+    assert 'content-encoding' not in client.get('/small', headers={'Accept-Encoding': 'gzip'}).headers
+    assert 'content-encoding' not in client.get('/stream', headers={'Accept-Encoding': 'identity'}).headers
+
+
+def test_passthrough_start_not_held():
+    sent = []
+
+    async def app(scope, receive, send):
+        await send(
+            {'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'text/event-stream')]}
+        )
+        # the client has the headers before the first event
+        assert [message['type'] for message in sent] == ['http.response.start']
+        await send({'type': 'http.response.body', 'body': b'data: {}\n\n', 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(CompressionMiddleware(app)({'type': 'http', 'headers': [(b'accept-encoding', b'gzip')]}, None, send))
+    assert sent[1]['body'] == b'data: {}\n\n'
+    assert (b'content-encoding', b'gzip') not in sent[0]['headers']
+
+
+def test_flushes_each_chunk(app):
+    middleware = CompressionMiddleware(app)
+    scope = {
+        'type': 'http',
+        'method': 'GET',
+        'path': '/stream',
+        'raw_path': b'/stream',
+        'root_path': '',
+        'scheme': 'http',
+        'query_string': b'',
+        'headers': [(b'accept-encoding', b'gzip')],
+        'server': ('testserver', 80),
+        'client': ('testclient', 50000),
+        'http_version': '1.1',
+    }
+    messages = []
+
+    async def receive():
+        await asyncio.sleep(1)
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(middleware(scope, receive, send))
+    bodies = [message['body'] for message in messages if message['type'] == 'http.response.body']
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    # each chunk decodes on arrival
+    assert decompressor.decompress(bodies[0]).decode('utf-8') == CHUNK
+    assert b''.join(decompressor.decompress(body) for body in bodies[1:]).decode('utf-8') == CHUNK * 2
+
+
+def test_zstd(app):
+    zstandard = pytest.importorskip('zstandard')
+    client = TestClient(app)
+    response = client.get('/stream', headers={'Accept-Encoding': 'zstd'}, stream=True)
+    assert response.headers['content-encoding'] == 'zstd'
+    raw = response.raw.read(decode_content=False)
+    decompressed = zstandard.ZstdDecompressor().decompressobj().decompress(raw)
+    assert decompressed.decode('utf-8') == CHUNK * 3
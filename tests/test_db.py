@@ -0,0 +1,182 @@
+import pytest
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from rethinkdb.errors import ReqlDriverError, ReqlOpFailedError
+from classifier_pipeline.db import ConnectionPool, Db
+
+
+@pytest.fixture
+def connections(mocker):
+    """Patch the pool to open mock connections, recorded in order"""
+    opened = []
+
+    def _open(self):
+        conn = mocker.MagicMock()
+        conn.is_open.return_value = True
+        opened.append(conn)
+        return conn
+
+    mocker.patch.object(ConnectionPool, '_open', _open)
+    return opened
+
+
+def test_pool_reuses_connections(connections):
+    pool = ConnectionPool(max_size=2)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        pass
+    assert first is second
+    assert len(connections) == 1
+
+
+def test_pool_max_size(connections):
+    pool = ConnectionPool(max_size=1, acquire_timeout=0.01)
+    conn = pool.acquire()
+    with pytest.raises(TimeoutError):
+        pool.acquire()
+    pool.release(conn)
+    assert pool.acquire() is conn
+
+
+def test_pool_replaces_closed_connection(connections):
+    pool = ConnectionPool(max_size=1)
+    with pool.connection() as first:
+        pass
+    first.is_open.return_value = False
+    with pool.connection() as second:
+        pass
+    assert second is not first
+    assert len(connections) == 2
+
+
+def test_pool_pings_idle_connection(connections, mocker):
+    pool = ConnectionPool(ping_after=0)
+    with pool.connection() as first:
+        pass
+    mocker.patch('rethinkdb.ast.RqlQuery.run', side_effect=ReqlDriverError('Connection is closed.'))
+    conn = pool.acquire()
+    assert conn is not first
+    first.close.assert_called_once()
+
+
+def test_pool_pings_outside_lock(connections, mocker):
+    pool = ConnectionPool(ping_after=0)
+    with pool.connection() as first:
+        pass
+    locked = []
+
+    def _check():
+        if pool._available.acquire(timeout=1):
+            pool._available.release()
+            locked.append(False)
+        else:
+            locked.append(True)
+
+    def _ping(conn):
+        # another thread can use the pool during the round trip
+        other = threading.Thread(target=_check)
+        other.start()
+        other.join()
+        return 0
+
+    mocker.patch('rethinkdb.ast.RqlQuery.run', side_effect=_ping)
+    assert pool.acquire() is first
+    assert locked == [False]
+
+
+def test_pool_closes_idle_connections(connections, mocker):
+    pool = ConnectionPool(idle_timeout=10, min_size=1)
+    first, second = pool.acquire(), pool.acquire()
+    pool.release(first)
+    pool.release(second)
+    monotonic = mocker.patch('classifier_pipeline.db.time.monotonic')
+    monotonic.return_value = 1e9
+    # the oldest is closed, min_size are kept
+    assert pool.acquire() is second
+    first.close.assert_called_once()
+
+
+def test_pool_discards_on_driver_error(connections):
+    pool = ConnectionPool()
+    idle = pool.acquire()
+    with pytest.raises(ReqlDriverError):
+        with pool.connection() as conn:
+            pool.release(idle)
+            raise ReqlDriverError('Connection is closed.')
+    conn.close.assert_called_once()
+    idle.close.assert_called_once()
+
+
+def test_db_retries_on_driver_error(connections, mocker):
+    mocker.patch('classifier_pipeline.db.time.sleep')
+    query = mocker.MagicMock()
+    query.run.side_effect = [ReqlDriverError('Connection is closed.'), {'inserted': 1}]
+    database = Db(retries=1)
+    assert database._run(query) == {'inserted': 1}
+    assert len(connections) == 2
+
+
+def test_db_raises_after_retries(connections, mocker):
+    mocker.patch('classifier_pipeline.db.time.sleep')
+    query = mocker.MagicMock()
+    query.run.side_effect = ReqlDriverError('Could not connect')
+    database = Db(retries=2)
+    with pytest.raises(ReqlDriverError):
+        database._run(query)
+    assert query.run.call_count == 3
+
+
+def test_db_increment_generation(mocker):
+    mocker.patch.object(Db, '_guarantee_table', side_effect=lambda name: Db()._r.db('classifier').table(name))
+    run = mocker.patch.object(Db, '_run', return_value={'inserted': 1})
+    Db().increment_generation('documents')
+    query = str(run.call_args.args[0])
+    # timed, for Last-Modified
+    assert "'generation': 1, 'modified': r.now()" in query
+    assert "'modified': var_" in query and "['modified']" in query
+
+
+def _schema(created, exists):
+    """A _run for a database where creates take a while, and fail once the db or table exists"""
+
+    def _run(query):
+        term = str(query)
+        if term.endswith('_list()'):
+            return list(created)
+        if '_create(' in term:
+            time.sleep(0.01)
+            if term in created:
+                raise ReqlOpFailedError(exists, query, [])
+            created.append(term)
+
+    return _run
+
+
+def test_db_guarantee_table_concurrently(mocker):
+    created = []
+    run = mocker.patch.object(Db, '_run', side_effect=_schema(created, 'already exists'))
+    database = Db()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        tables = [f.result() for f in [executor.submit(database._guarantee_table, 'documents') for _ in range(4)]]
+    assert all(table is not None for table in tables)
+    assert sorted(created) == ["r.db('classifier').table_create('documents')", "r.db_create('classifier')"]
+    assert 'documents' in database._tables
+    # cached
+    calls = run.call_count
+    database._guarantee_table('documents')
+    assert run.call_count == calls
+
+
+def test_db_created_by_another_client(mocker):
+    database = Db()
+    create = database._r.db('classifier').table_create('documents')
+    exists = ReqlOpFailedError('Table `classifier.documents` already exists.', create, [])
+    # the table is listed before, and created after, another client creates it
+    mocker.patch.object(Db, '_run', side_effect=[['classifier'], [], exists])
+    assert database._guarantee_table('documents') is not None
+
+    database._run.side_effect = [[], ReqlOpFailedError('Database is read-only.', create, [])]
+    with pytest.raises(ReqlOpFailedError):
+        database._guarantee_table('other', refresh=True)
@@ -48,6 +48,41 @@ class TestDbInstance:
         found_update = table.get(update['id']).run(conn)
         assert found_update['field1'] == update['field1']
 
+    def test_table_handle_cached(self):
+        table_name = 'cachedtable'
+        _, _, _, table = self.db.access_table(table_name)
+        _, _, _, cached = self.db.access_table(table_name)
+        assert cached is table
+
+        self.db.invalidate(table_name)
+        _, _, _, revalidated = self.db.access_table(table_name)
+        assert revalidated is not table
+
+        _, _, _, refreshed = self.db.access_table(table_name, refresh=True)
+        assert refreshed is not revalidated
+
+    def test_guarantee_index(self):
+        table_name = 'sometable'
+        self.db.guarantee_index(table_name, 'field1')
+        self.db.guarantee_index(table_name, 'field1')
+        _, conn, _, table = self.db.access_table(table_name)
+        assert 'field1' in table.index_list().run(conn)
+
+    def test_guarantee_compound_index(self):
+        table_name = 'sometable'
+        self.db.guarantee_index(table_name, 'field1_id', fields=['field1', 'id'])
+        _, conn, _, table = self.db.access_table(table_name)
+        self.db.set(table_name, {'id': '1', 'field1': 2})
+        found = list(table.between([2, r.minval], [2, r.maxval], index='field1_id').run(conn))
+        assert [doc['id'] for doc in found] == ['1']
+
+    def test_pool_recovers_closed_connections(self):
+        table_name = 'sometable'
+        self.db.set(table_name, {'id': '1', 'field1': 1})
+        for conn, _ in self.db._pool._idle:
+            conn.close()
+        assert self.db.get(table_name, '1')['field1'] == 1
+
 
 ####################################################
 #                  Load
@@ -58,3 +93,10 @@ def test_db_loader(dict_items):
     results = db_loader(table_name='test')(dict_items)
     for result in results:
         assert result is not None
+
+
+def test_db_loader_batched(dict_items):
+    results = list(db_loader(table_name='test', batch_size=10)(dict_items))
+    assert len(results) == 1
+    assert results[0]['errors'] == 0
+    assert results[0]['inserted'] + results[0]['replaced'] + results[0]['unchanged'] == 2
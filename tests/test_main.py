@@ -0,0 +1,445 @@
+import asyncio
+import json
+import pytest
+from datetime import datetime
+import pytz
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from classifier_pipeline import main
+from classifier_pipeline.db import AsyncDb
+
+PUB_DATE = datetime(2022, 5, 24, tzinfo=pytz.UTC)
+ETAG = 'W/"0123456789abcdef"'
+LAST_MODIFIED = 'Tue, 24 May 2022 00:00:00 GMT'
+
+
+@pytest.fixture(autouse=True)
+def plan(mocker):
+    return mocker.patch('classifier_pipeline.main.plan', return_value=True)
+
+
+@pytest.fixture(autouse=True)
+def page_end(mocker):
+    return mocker.patch('classifier_pipeline.main.page_end', return_value=None)
+
+
+@pytest.fixture
+def documents():
+    return [{'id': str(i), 'pmid': str(i), 'pub_date': PUB_DATE} for i in range(5)]
+
+
+async def _aiter(items):
+    for item in items:
+        yield item
+
+
+async def _collect(chunks):
+    return [chunk async for chunk in chunks]
+
+
+def test_cursor_round_trip():
+    token = main.to_cursor({'id': '1', 'pub_date': PUB_DATE})
+    assert main.from_cursor(token) == (PUB_DATE, '1')
+    assert main.to_cursor({'id': '1', 'pub_date': None}) is None
+
+
+def test_invalid_cursor():
+    with pytest.raises(HTTPException) as e:
+        main.from_cursor('not-a-cursor')
+    assert e.value.status_code == 400
+
+
+def _day(day: str) -> datetime:
+    return datetime.strptime(day, '%Y-%m-%d').replace(tzinfo=pytz.UTC)
+
+
+def test_fraction():
+    low, high = _day('2022-01-01'), _day('2022-01-11')
+    # unknown extents (e.g. an empty table)
+    assert main._fraction(None, low, high) == 1.0
+    assert main._fraction([None, None], low, high) == 1.0
+    assert main._fraction([low, high], low, high) == 1.0
+    assert main._fraction([low, high], _day('2022-01-06'), main.MAX_DATE_TIME) == 0.5
+    assert main._fraction([low, high], _day('2021-01-01'), _day('2022-01-02')) == 0.1
+    # disjoint
+    assert main._fraction([low, high], _day('2023-01-01'), main.MAX_DATE_TIME) == 0.0
+    # a single value
+    assert main._fraction([low, low], low, high) == 1.0
+    assert main._fraction([low, low], high, main.MAX_DATE_TIME) == 0.0
+
+
+def test_use_last_updated_index(mocker):
+    extents = {
+        'last_updated': [_day('2022-01-01'), _day('2022-01-11')],
+        'pub_date': [_day('2000-01-01'), _day('2022-01-01')],
+    }
+    mocker.patch('rethinkdb.ast.RqlQuery.run', new=mocker.AsyncMock(return_value=extents))
+    narrow_last_updated = main.to_selection('2022-01-10', main.MAX_DATE, main.MIN_DATE, main.MAX_DATE)
+    narrow_pub_date = main.to_selection(main.MIN_DATE, main.MAX_DATE, '2021-12-01', main.MAX_DATE)
+    assert asyncio.run(main._use_last_updated_index(None, narrow_last_updated)) is True
+    assert asyncio.run(main._use_last_updated_index(None, narrow_pub_date)) is False
+    # an empty table
+    mocker.patch(
+        'rethinkdb.ast.RqlQuery.run', new=mocker.AsyncMock(return_value={'last_updated': None, 'pub_date': None})
+    )
+    assert asyncio.run(main._use_last_updated_index(None, narrow_last_updated)) is False
+
+
+def test_select_cursor_bounds():
+    after = (_day('2022-01-01'), '5')
+    selection = main.to_selection(
+        main.MIN_DATE,
+        main.MAX_DATE,
+        main.MIN_DATE,
+        '2023-01-01',
+        main.to_cursor({'pub_date': after[0], 'id': after[1]}),
+    )
+    # the index range ends at the cursor
+    by_pub_date = str(main._select(selection, False))
+    assert "r.iso8601('2022-01-01T00:00:00+00:00'), '5'], index='pub_date_id'" in by_pub_date
+    # or at the end date, when the cursor is past it
+    past_end = selection._replace(end_date=_day('2021-01-01'))
+    assert "r.iso8601('2021-01-01T00:00:00+00:00'), r.minval], index='pub_date_id'" in str(
+        main._select(past_end, False)
+    )
+    # over the last updated index, the documents following the cursor are filtered
+    by_last_updated = str(main._select(selection, True))
+    assert "['id']]) < r.expr([r.iso8601('2022-01-01T00:00:00+00:00'), '5'])" in by_last_updated
+
+
+def test_select_through_bounds():
+    selection = main.to_selection(main.MIN_DATE, main.MAX_DATE, main.MIN_DATE, main.MAX_DATE)
+    through = (_day('2021-06-01'), '7')
+    # the index range starts at (and includes) the end of the page
+    by_pub_date = str(main._select(selection, False, through=through))
+    assert "between([r.iso8601('2021-06-01T00:00:00+00:00'), '7'], " in by_pub_date
+    by_last_updated = str(main._select(selection, True, through=through))
+    assert "['id']]) >= r.expr([r.iso8601('2021-06-01T00:00:00+00:00'), '7'])" in by_last_updated
+
+
+def test_select_index():
+    selection = main.to_selection(main.MIN_DATE, main.MAX_DATE, main.MIN_DATE, main.MAX_DATE)
+    by_last_updated = str(main._select(selection, True))
+    assert "index='last_updated'" in by_last_updated and 'order_by(r.desc' in by_last_updated
+    assert 'order_by' not in str(main._select(selection, True, ordered=False))
+    by_pub_date = str(main._select(selection, False))
+    assert "index='pub_date_id'" in by_pub_date and "order_by(index=r.desc('pub_date_id'))" in by_pub_date
+
+
+def test_as_json_chunks(documents):
+    chunks = asyncio.run(_collect(main._as_json(_aiter(documents), size=2)))
+    assert len(chunks) == 3
+    assert [item['id'] for item in json.loads(''.join(chunks))] == ['0', '1', '2', '3', '4']
+    assert asyncio.run(_collect(main._as_json(_aiter([])))) == ['[]']
+
+
+def test_as_ndjson_chunks(documents):
+    chunks = asyncio.run(_collect(main._as_ndjson(_aiter(documents), size=2)))
+    assert len(chunks) == 3
+    assert [json.loads(line)['id'] for line in ''.join(chunks).splitlines()] == ['0', '1', '2', '3', '4']
+
+
+def test_as_csv_chunks(documents):
+    chunks = asyncio.run(_collect(main._as_csv(_aiter(documents), rows=2)))
+    # header and first row, then chunks of rows
+    assert len(chunks) == 3
+    assert ''.join(chunks).splitlines()[0] == 'id,pmid,pub_date'
+    assert asyncio.run(_collect(main._as_csv(_aiter([])))) == []
+
+
+def test_feed(mocker, documents, plan, page_end):
+    load = mocker.patch('classifier_pipeline.main.load', side_effect=lambda *args: _aiter(documents))
+    page_end.return_value = (PUB_DATE, '4')
+    client = TestClient(main.app)
+    response = client.get('/', params={'limit': 5, 'retmode': 'ndjson'})
+    assert response.status_code == 200
+    # no validator while the generation is unknown
+    assert 'ETag' not in response.headers
+    # the page is full: the token is outside the body, which only has the documents
+    assert main.from_cursor(response.headers['X-Next-Cursor']) == (PUB_DATE, '4')
+    assert [json.loads(line)['id'] for line in response.text.splitlines()] == ['0', '1', '2', '3', '4']
+    selection, limit, skip, projection, by_last_updated, through = load.call_args.args
+    assert selection.after is None and limit == 5 and skip == 0 and projection is None
+    plan.assert_awaited_once()
+    assert by_last_updated is True
+    # the page ends at the document the token is made from
+    assert through == (PUB_DATE, '4')
+    assert page_end.await_args.args[1:] == (5, 0, True)
+
+
+def test_feed_last_page(mocker, documents):
+    load = mocker.patch('classifier_pipeline.main.load', side_effect=lambda *args: _aiter(documents))
+    client = TestClient(main.app)
+    response = client.get('/', params={'limit': 6})
+    assert [item['id'] for item in response.json()] == ['0', '1', '2', '3', '4']
+    assert 'X-Next-Cursor' not in response.headers
+    assert load.call_args.args[-1] is None
+
+
+def test_feed_csv_cursor(mocker, documents, page_end):
+    mocker.patch('classifier_pipeline.main.load', side_effect=lambda *args: _aiter(documents))
+    page_end.return_value = (PUB_DATE, '4')
+    client = TestClient(main.app)
+    response = client.get('/', params={'limit': 5, 'retmode': 'csv'})
+    assert main.from_cursor(response.headers['X-Next-Cursor']) == (PUB_DATE, '4')
+    assert len(response.text.splitlines()) == 6
+
+
+def test_feed_invalid_cursor(mocker):
+    client = TestClient(main.app)
+    response = client.get('/', params={'cursor': 'not-a-cursor'})
+    assert response.status_code == 400
+
+
+def test_async_db_reuses_connections(mocker):
+    database = AsyncDb(max_connections=2)
+    conn = mocker.MagicMock()
+    conn.is_open.return_value = True
+    connect = mocker.patch.object(AsyncDb, '_connect', return_value=conn)
+
+    async def _use():
+        async with database.connection() as c:
+            return c
+
+    async def _run():
+        first = await _use()
+        second = await _use()
+        return first, second
+
+    assert asyncio.run(_run()) == (conn, conn)
+    assert connect.await_count == 1
+
+
+def test_async_db_discards_connection_on_error(mocker):
+    database = AsyncDb()
+    conn = mocker.AsyncMock()
+    conn.is_open = mocker.MagicMock(return_value=True)
+    connect = mocker.patch.object(AsyncDb, '_connect', return_value=conn)
+
+    async def _fail():
+        async with database.connection():
+            raise RuntimeError('query failed')
+
+    async def _run():
+        with pytest.raises(RuntimeError):
+            await _fail()
+        async with database.connection():
+            pass
+
+    asyncio.run(_run())
+    conn.close.assert_awaited_once()
+    assert connect.await_count == 2
+
+
+def test_feed_cached(mocker, documents, page_end):
+    page_end.return_value = (PUB_DATE, '4')
+    mocker.patch.object(main, 'response_cache', main.ResponseCache())
+    main.response_cache.set_generation(1)
+    load = mocker.patch('classifier_pipeline.main.load', side_effect=lambda *args: _aiter(documents))
+    client = TestClient(main.app)
+    first = client.get('/', params={'limit': 5})
+    second = client.get('/', params={'skip': 0, 'limit': 5})
+    assert load.call_count == 1
+    assert second.text == first.text
+    assert second.headers['X-Next-Cursor'] == first.headers['X-Next-Cursor']
+    assert page_end.await_count == 1
+    assert second.headers['content-type'] == 'application/json'
+
+    main.response_cache.set_generation(2)
+    client.get('/', params={'limit': 5})
+    assert load.call_count == 2
+
+
+def test_feed_not_modified(mocker, documents, plan):
+    # nothing is cached, so the validators are computed for each request
+    mocker.patch.object(main, 'response_cache', main.ResponseCache(max_entry_bytes=0))
+    main.response_cache.set_generation(1)
+    load = mocker.patch('classifier_pipeline.main.load', side_effect=lambda *args: _aiter(documents))
+    client = TestClient(main.app)
+    etag = client.get('/').headers['ETag']
+    assert load.call_count == 1 and plan.await_count == 1
+    response = client.get('/', headers={'If-None-Match': f'"other", {etag}'})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert response.content == b''
+    # without querying the database
+    assert load.call_count == 1 and plan.await_count == 1
+
+    main.response_cache.set_generation(2)
+    response = client.get('/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert load.call_count == 2
+
+
+def test_feed_not_modified_since(mocker, documents):
+    mocker.patch.object(main, 'response_cache', main.ResponseCache(max_entry_bytes=0))
+    main.response_cache.set_generation(1, PUB_DATE)
+    load = mocker.patch('classifier_pipeline.main.load', side_effect=lambda *args: _aiter(documents))
+    client = TestClient(main.app)
+    assert client.get('/').headers['Last-Modified'] == LAST_MODIFIED
+    response = client.get('/', headers={'If-Modified-Since': LAST_MODIFIED})
+    assert response.status_code == 304
+    assert load.call_count == 1
+
+    # written since
+    main.response_cache.set_generation(2, datetime(2022, 5, 25, tzinfo=pytz.UTC))
+    response = client.get('/', headers={'If-Modified-Since': LAST_MODIFIED})
+    assert response.status_code == 200
+    assert response.headers['Last-Modified'] == 'Wed, 25 May 2022 00:00:00 GMT'
+
+
+def test_validators():
+    key = ('a', 1)
+    assert main.validators(key, None) == {}
+    etag = main.validators(key, 1)['ETag']
+    assert etag.startswith('W/"') and main.validators(key, 1)['ETag'] == etag
+    assert main.validators(key, 2)['ETag'] != etag
+    assert main.validators(('b', 1), 1)['ETag'] != etag
+    assert 'Last-Modified' not in main.validators(key, 1)
+    assert main.validators(key, 1, PUB_DATE)['Last-Modified'] == LAST_MODIFIED
+
+
+def test_not_modified_since():
+    headers = {'ETag': ETAG, 'Last-Modified': LAST_MODIFIED}
+    assert main.not_modified(headers, None, LAST_MODIFIED)
+    assert main.not_modified(headers, None, 'Wed, 25 May 2022 00:00:00 GMT')
+    assert not main.not_modified(headers, None, 'Mon, 23 May 2022 00:00:00 GMT')
+    assert not main.not_modified(headers, None, 'not a date')
+    # If-None-Match takes precedence
+    assert not main.not_modified(headers, '"other"', LAST_MODIFIED)
+    assert main.not_modified(headers, '*', None)
+    assert not main.not_modified({}, None, LAST_MODIFIED)
+
+
+def test_as_event_stream_heartbeat():
+    async def _slow():
+        yield {'id': '1'}
+        await asyncio.sleep(0.05)
+        yield {'id': '2'}
+
+    events = asyncio.run(_collect(main._as_event_stream(_slow(), heartbeat=0.01)))
+    assert events[0] == 'data: {"id":"1"}\n\n'
+    assert events[-1] == 'data: {"id":"2"}\n\n'
+    assert ': heartbeat\n\n' in events[1:-1]
+
+
+def test_changes(mocker, documents):
+    load_changes = mocker.patch('classifier_pipeline.main.load_changes', side_effect=lambda *args: _aiter(documents))
+    client = TestClient(main.app)
+    response = client.get('/changes', params={'start': '2022-05-24'})
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/event-stream')
+    events = [json.loads(line[len('data: ') :]) for line in response.text.splitlines() if line]
+    assert [event['id'] for event in events] == ['0', '1', '2', '3', '4']
+    load_changes.assert_called_once_with(PUB_DATE)
+
+
+def test_changes_merge(mocker):
+    merged = {'articleCitation': 'J Things, 2022', 'authorName': 'Ann', 'emailRecipientAddress': 'ann@example.org'}
+    stored = {'pmid': '1', 'doi': None, 'pub_date': PUB_DATE, 'last_updated': PUB_DATE, 'merge': merged}
+    # an update for an address already sent is sent too
+    mocker.patch('classifier_pipeline.main.load_changes', side_effect=lambda *args: _aiter([stored, stored]))
+    client = TestClient(main.app)
+    response = client.get('/changes', params={'rettype': 'merge'})
+    events = [json.loads(line[len('data: ') :]) for line in response.text.splitlines() if line]
+    assert [event['emailRecipientAddress'] for event in events] == ['ann@example.org', 'ann@example.org']
+
+
+def test_as_merge():
+    merged = {'articleCitation': 'J Things, 2022', 'authorName': 'Ann', 'emailRecipientAddress': 'ann@example.org'}
+    stored = {'pmid': '1', 'doi': None, 'pub_date': PUB_DATE, 'last_updated': PUB_DATE, 'merge': merged}
+    legacy = {
+        'pmid': '2',
+        'doi': None,
+        'pub_date': PUB_DATE,
+        'last_updated': PUB_DATE,
+        'journal': {'title': 'Journal of Things'},
+        'author_list': [{'fore_name': 'Bob', 'emails': ['bob@example.org']}],
+        'correspondence': [],
+    }
+    # the second document with Ann's email is dropped
+    items = asyncio.run(_collect(main._as_merge(_aiter([stored, legacy, dict(stored, pmid='3')]))))
+    assert [item['pmid'] for item in items] == ['1', '2']
+    assert items[0]['articleCitation'] == 'J Things, 2022'
+    assert items[1]['articleCitation'] == 'Journal of Things, 2022'
+    assert items[1]['emailRecipientAddress'] == 'bob@example.org'
+    # without dedup, as for changes
+    items = asyncio.run(_collect(main._as_merge(_aiter([stored, legacy, dict(stored, pmid='3')]), dedup=False)))
+    assert [item['pmid'] for item in items] == ['1', '2', '3']
+
+
+def test_feed_merge_projection(mocker):
+    load = mocker.patch('classifier_pipeline.main.load', side_effect=lambda *args: _aiter([]))
+    client = TestClient(main.app)
+    client.get('/', params={'rettype': 'merge'})
+    assert load.call_args.args[3] is main._project_merge
+
+
+def test_to_fields():
+    assert main.to_fields('title, pmid,,journal.title,pmid') == ['journal.title', 'pmid', 'title']
+    for invalid in ['secret', 'journal.secret', 'pmid.nested']:
+        with pytest.raises(HTTPException) as e:
+            main.to_fields(invalid)
+        assert e.value.status_code == 400
+
+
+def test_project_fields(mocker):
+    project = main._project_fields(['author_list.fore_name', 'journal', 'journal.title', 'pmid'])
+    doc = mocker.MagicMock()
+    project(doc)
+    doc.pluck.assert_called_once_with('journal', 'pmid', {'author_list': ['fore_name']})
+
+
+def test_feed_fields(mocker):
+    load = mocker.patch('classifier_pipeline.main.load', side_effect=lambda *args: _aiter([]))
+    client = TestClient(main.app)
+    assert client.get('/', params={'fields': 'pmid,journal.title'}).status_code == 200
+    assert load.call_args.args[3] is not None
+    assert client.get('/', params={'fields': 'secret'}).status_code == 400
+    assert client.get('/', params={'fields': 'pmid', 'rettype': 'merge'}).status_code == 400
+
+
+def test_to_stats():
+    aggregates = {
+        'count': 3,
+        'probability': [{'group': 9.0, 'reduction': 2}, {'group': 5.0, 'reduction': 1}],
+        'pub_date': [{'group': [2022, 5], 'reduction': 3}],
+        'last_updated': [{'group': [2022, 5], 'reduction': 1}, {'group': [2022, 6], 'reduction': 2}],
+    }
+    stats = main.to_stats(aggregates, bins=10)
+    assert stats['count'] == 3
+    assert len(stats['probability']) == 10
+    assert stats['probability'][9] == {'lower': 0.9, 'upper': 1.0, 'count': 2}
+    assert stats['probability'][0]['count'] == 0
+    assert stats['months'] == [
+        {'month': '2022-05', 'pub_date': 3, 'last_updated': 1},
+        {'month': '2022-06', 'pub_date': 0, 'last_updated': 2},
+    ]
+
+
+def test_stats(mocker):
+    aggregates = {'count': 0, 'probability': [], 'pub_date': [], 'last_updated': []}
+    aggregate = mocker.patch('classifier_pipeline.main.aggregate', return_value=aggregates)
+    client = TestClient(main.app)
+    response = client.get('/stats', params={'pubstart': '2022-01-01', 'bins': 4})
+    assert response.status_code == 200
+    assert response.json()['count'] == 0
+    assert len(response.json()['probability']) == 4
+    selection, bins = aggregate.call_args.args
+    assert selection.start_date == datetime(2022, 1, 1, tzinfo=pytz.UTC) and bins == 4
+
+
+def test_feed_arrow(mocker, documents):
+    pyarrow = pytest.importorskip('pyarrow')
+    mocker.patch('classifier_pipeline.main.load', side_effect=lambda *args: _aiter(documents))
+    client = TestClient(main.app)
+    response = client.get('/', params={'retmode': 'arrow'})
+    assert response.headers['content-type'] == 'application/vnd.apache.arrow.stream'
+    table = pyarrow.ipc.open_stream(response.content).read_all()
+    assert table.column('pmid').to_pylist() == ['0', '1', '2', '3', '4']
+
+
+def test_feed_columnar_unavailable(mocker):
+    mocker.patch('classifier_pipeline.main.columnar.available', return_value=False)
+    client = TestClient(main.app)
+    assert client.get('/', params={'retmode': 'parquet'}).status_code == 501
@@ -0,0 +1,45 @@
+import pytest
+from datetime import datetime
+import pytz
+from classifier_pipeline.merge import get_author, get_citation, merge_fields
+
+
+@pytest.fixture
+def document():
+    return {
+        'pmid': '1',
+        'journal': {'title': 'Journal of Things', 'iso_abbreviation': 'J Things'},
+        'pub_date': datetime(2022, 5, 24, tzinfo=pytz.UTC),
+        'author_list': [
+            {'fore_name': 'Ann', 'emails': ['ann@example.org']},
+            {'fore_name': 'Bob', 'emails': None},
+        ],
+        'correspondence': [{'emails': ['corresponding@example.org']}],
+    }
+
+
+def test_get_citation(document):
+    assert get_citation(document) == 'J Things, 2022'
+    document['journal'] = {'title': 'Journal of Things', 'iso_abbreviation': None}
+    assert get_citation(document) == 'Journal of Things, 2022'
+    document['pub_date'] = None
+    assert get_citation(document) == 'Journal of Things'
+
+
+def test_get_author_with_email(document):
+    assert get_author(document) == {'emailRecipientAddress': 'ann@example.org', 'authorName': 'Ann'}
+
+
+def test_get_author_correspondence(document):
+    document['author_list'][0]['emails'] = None
+    assert get_author(document) == {'emailRecipientAddress': 'corresponding@example.org', 'authorName': 'Bob'}
+    document['correspondence'] = []
+    assert get_author(document) == {'emailRecipientAddress': None, 'authorName': 'Bob'}
+
+
+def test_merge_fields(document):
+    assert merge_fields(document) == {
+        'articleCitation': 'J Things, 2022',
+        'authorName': 'Ann',
+        'emailRecipientAddress': 'ann@example.org',
+    }
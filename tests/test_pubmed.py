@@ -3,17 +3,29 @@ from classifier_pipeline.pubmed import (
     updatefiles_extractor,
     updatefiles_data_filter,
     updatefiles_content2facts_transformer,
+    updatefiles_facts_db_filter,
     citation_pubtype_filter,
     classification_transformer,
     pubmed_transformer,
     prediction_db_transformer,
     citation_date_filter,
     pmc_supplement_transfomer,
+    merge_transformer,
+    updatefiles_downloader,
+    citation_db_filter,
+    classifier_version,
+    classifier_pool,
+    content_hash,
 )
+from classifier_pipeline.cache import FileCache
 from ncbiutils.pubmedxmlparser import Citation
 from ncbiutils.ncbiutils import Chunk
 from pathway_abstract_classifier.pathway_abstract_classifier import Prediction
+from concurrent.futures import ProcessPoolExecutor
+import classifier_pipeline.pubmed
+import os
 import datetime
+import gzip
 
 uids = ('1', '2', '3')
 citations = (
@@ -380,6 +392,36 @@ pmc_docs_data = [
 ]
 
 
+def as_updatefile(pmid):
+    xml = f'''<?xml version="1.0" ?>
+    <!DOCTYPE PubmedArticleSet PUBLIC "-//NLM//DTD PubMedArticle, 1st January 2019//EN" "https://dtd.nlm.nih.gov/ncbi/pubmed/out/pubmed_190101.dtd">
+    <PubmedArticleSet>
+      <PubmedArticle>
+        <MedlineCitation Status="MEDLINE" Owner="NLM">
+          <PMID Version="1">{pmid}</PMID>
+          <Article PubModel="Print">
+            <Journal><JournalIssue><PubDate><Year>2022</Year></PubDate></JournalIssue><Title>Journal</Title></Journal>
+            <ArticleTitle>title{pmid}</ArticleTitle>
+            <PublicationTypeList><PublicationType UI="D016428">Journal Article</PublicationType></PublicationTypeList>
+          </Article>
+        </MedlineCitation>
+      </PubmedArticle>
+    </PubmedArticleSet>'''
+    return gzip.compress(xml.strip().encode('utf-8'))
+
+
+@pytest.fixture
+def updatefile_responses(mocker):
+    def _request(url):
+        filename = url.split('/')[-1]
+        if filename == 'missing.xml.gz':
+            return Exception('Not found'), None
+        pmid = filename.split('.')[0]
+        return None, mocker.Mock(content=as_updatefile(pmid))
+
+    return _request
+
+
 @pytest.fixture
 def citation_items():
     return (c for c in citations)
@@ -451,6 +493,17 @@ def test_updatefiles_data_filter(list_contents):
         assert '.html' not in name
 
 
+def test_updatefiles_facts_db_filter(mocker, list_contents):
+    facts = list(updatefiles_content2facts_transformer(updatefiles_data_filter()(list_contents)))
+    known = [{'id': facts[0]['id']}]
+    get_many = mocker.patch('classifier_pipeline.pubmed.db.Db.get_many', return_value=known)
+    set_many = mocker.patch('classifier_pipeline.pubmed.db.Db.set_many')
+    filenames = list(updatefiles_facts_db_filter()(f for f in facts))
+    assert filenames == [f['id'] for f in facts[1:]]
+    get_many.assert_called_once()
+    set_many.assert_called_once_with(table_name='contents', data=facts[1:])
+
+
 def test_citation_pubtype_filter(citation_items):
     results = list(citation_pubtype_filter(citation_items))
     assert len(results) == 1
@@ -466,6 +519,38 @@ def test_citation_date_filter_disabled(citation_items):
     assert len(citations) == 3
 
 
+def test_classifier_version():
+    assert classifier_version(threshold=0.5) == classifier_version()
+    assert classifier_version(threshold=0.99) != classifier_version(threshold=0.5)
+    assert classifier_version(model_url='a', threshold=0.5) != classifier_version(model_url='b', threshold=0.5)
+
+
+def test_citation_db_filter(mocker, citation_items):
+    version = classifier_version()
+    items = list(citation_items)
+    known = [
+        {'id': '1', 'model_version': version, 'content_hash': content_hash(items[0].dict())},
+        {'id': '2', 'model_version': 'previous', 'content_hash': content_hash(items[1].dict())},
+    ]
+    get_many = mocker.patch('classifier_pipeline.pubmed.db.Db.get_many', return_value=known)
+    results = list(citation_db_filter(model_version=version, size=2)(c for c in items))
+    assert [c.pmid for c in results] == ['2', '3']
+    assert get_many.call_count == 2
+
+
+def test_citation_db_filter_revised(mocker, citation_items):
+    version = classifier_version()
+    items = list(citation_items)
+    known = [
+        {'id': '1', 'model_version': version, 'content_hash': content_hash(items[0].dict())},
+        {'id': '2', 'model_version': version, 'content_hash': 'before the revision'},
+        {'id': '3', 'model_version': version},
+    ]
+    mocker.patch('classifier_pipeline.pubmed.db.Db.get_many', return_value=known)
+    results = list(citation_db_filter(model_version=version)(c for c in items))
+    assert [c.pmid for c in results] == ['2', '3']
+
+
 ####################################################
 #                  Transform
 ####################################################
@@ -486,22 +571,114 @@ def test_classification_transformer(mocker, citation_chunks, prediction_items):
     assert len(p_list) == 2
 
 
+def as_predictions(documents):
+    return [Prediction(document=d, classification=1, probability=1) for d in documents]
+
+
+def test_classification_transformer_workers(mocker, citation_items):
+    mocker.patch('classifier_pipeline.pubmed.Classifier.predict', side_effect=as_predictions)
+    chunks = ([c] for c in citation_items)
+    predictions = list(classification_transformer(workers=2, queue_size=2)(chunks))
+    assert [p.document['pmid'] for p in predictions] == [c.pmid for c in citations]
+
+
+def test_classification_transformer_workers_unordered(mocker, citation_items):
+    mocker.patch('classifier_pipeline.pubmed.Classifier.predict', side_effect=as_predictions)
+    chunks = ([c] for c in citation_items)
+    predictions = list(classification_transformer(workers=2, ordered=False)(chunks))
+    assert sorted(p.document['pmid'] for p in predictions) == sorted(c.pmid for c in citations)
+
+
+def test_classification_transformer_workers_shutdown(mocker, citation_items):
+    mocker.patch('classifier_pipeline.pubmed.Classifier.predict', side_effect=as_predictions)
+    shutdown = mocker.spy(ProcessPoolExecutor, 'shutdown')
+    predictions = classification_transformer(workers=1)([c] for c in citation_items)
+    next(predictions)
+    predictions.close()
+    shutdown.assert_called_once()
+
+
+def test_classification_transformer_shared_pool(mocker, citation_items, tmp_path):
+    mocker.patch('classifier_pipeline.pubmed.Classifier.predict', side_effect=as_predictions)
+    initializer = classifier_pipeline.pubmed._init_classifier_worker
+    inits = tmp_path / 'inits'
+
+    def _init(opts):
+        with open(inits, 'a') as f:
+            f.write(f'{os.getpid()}\n')
+        initializer(opts)
+
+    mocker.patch('classifier_pipeline.pubmed._init_classifier_worker', side_effect=_init)
+    shutdown = mocker.spy(ProcessPoolExecutor, 'shutdown')
+    items = list(citation_items)
+    with classifier_pool(1) as pool:
+        # e.g. one pipeline per update file
+        for _ in range(3):
+            predictions = list(classification_transformer(workers=1, pool=pool)([c] for c in items))
+            assert [p.document['pmid'] for p in predictions] == [c.pmid for c in citations]
+        shutdown.assert_not_called()
+    assert len(inits.read_text().split()) == 1
+
+
 def test_pubmed_transformer(mocker, uid_items, citations_chunks):
     mocker.patch('classifier_pipeline.pubmed.PubMedFetch.get_citations', return_value=citations_chunks)
     citations = list(pubmed_transformer()(uid_items))
     assert len(citations) == 3
 
 
+def test_updatefiles_downloader(mocker, updatefile_responses):
+    mocker.patch('classifier_pipeline.pubmed.PubMedDownload._request', side_effect=updatefile_responses)
+    files = ['1.xml.gz', 'missing.xml.gz', '2.xml.gz']
+    chunks = list(updatefiles_downloader()(f for f in files))
+    assert [c.ids for c in chunks] == [[f] for f in files]
+    assert chunks[0].citations[0].pmid == '1'
+    assert chunks[1].error is not None
+    assert chunks[2].citations[0].pmid == '2'
+
+
+def test_updatefiles_downloader_parallel_preserves_order(mocker, updatefile_responses):
+    mocker.patch('classifier_pipeline.pubmed.PubMedDownload._request', side_effect=updatefile_responses)
+    files = [f'{n}.xml.gz' for n in range(1, 8)]
+    chunks = list(updatefiles_downloader(workers=3)(f for f in files))
+    assert [c.ids[0] for c in chunks] == files
+    assert [c.citations[0].pmid for c in chunks] == [str(n) for n in range(1, 8)]
+
+
+def test_updatefiles_downloader_cached(mocker, tmp_path, updatefile_responses):
+    request = mocker.patch('classifier_pipeline.pubmed.PubMedDownload._request', side_effect=updatefile_responses)
+    cache = FileCache(path=str(tmp_path))
+    facts = {'id': '1.xml.gz', 'filename': '1.xml.gz', 'modify': '20211213192136'}
+    first = list(updatefiles_downloader(cache=cache)(f for f in [facts]))
+    second = list(updatefiles_downloader(cache=cache)(f for f in [facts]))
+    assert request.call_count == 1
+    assert first[0].ids == second[0].ids == ['1.xml.gz']
+    assert second[0].citations[0].pmid == '1'
+
+
 def test_prediction_db_transformer(prediction_items):
     formatted = list(prediction_db_transformer()(prediction_items))
     for item in formatted:
         assert 'id' in item
         assert 'last_updated' in item
         assert 'pub_date' in item
+        assert 'model_version' in item
         if item['pub_date'] is not None:
             assert isinstance(item['pub_date'], datetime.datetime)
 
 
+def test_prediction_db_transformer_content_hash(citation_items):
+    items = list(citation_items)
+    predictions = as_predictions([c.dict() for c in items])
+    formatted = list(prediction_db_transformer()(p for p in predictions))
+    assert [d['content_hash'] for d in formatted] == [content_hash(c.dict()) for c in items]
+
+
+def test_merge_transformer(prediction_items):
+    documents = list(merge_transformer()(prediction_db_transformer()(prediction_items)))
+    for document in documents:
+        assert set(document['merge'].keys()) == {'articleCitation', 'authorName', 'emailRecipientAddress'}
+
+
 def test_pmc_supplement_transfomer(mocker, pmc_docs, pmc_citation_chunks):
     mocker.patch('classifier_pipeline.pubmed.PubMedFetch.get_citations', return_value=pmc_citation_chunks)
     merged = list(pmc_supplement_transfomer()(pmc_docs))
@@ -1,5 +1,17 @@
 import pytest
-from classifier_pipeline.utils import csv2dict_reader, filter, limit_filter, list_transformer, chunker, as_pipeline
+from classifier_pipeline.utils import (
+    csv2dict_reader,
+    filter,
+    limit_filter,
+    list_transformer,
+    chunker,
+    as_pipeline,
+    db_loader,
+    prefetch,
+    exhaust,
+    PipelineStats,
+)
+import threading
 
 
 @pytest.fixture
@@ -32,6 +44,43 @@ def test_as_pipeline():
     assert result == afunc
 
 
+def test_as_pipeline_stats(numeric_items):
+    stats = PipelineStats(interval=None)
+    results = list(as_pipeline([numeric_items, filter(lambda x: x < 5), chunker(2)], stats=stats))
+    assert len(results) == 3
+    source, filtered, chunked = stats.stages.values()
+    assert source.items_out == 10
+    assert (filtered.name, filtered.items_in, filtered.items_out) == ('filter', 10, 5)
+    assert (chunked.name, chunked.items_in, chunked.items_out) == ('chunker', 5, 3)
+    assert all(stage.seconds >= 0 for stage in stats.stages.values())
+    assert 'chunker' in stats.summary()
+
+
+def test_as_pipeline_stats_sink(numeric_items):
+    stats = PipelineStats(interval=None)
+    result = as_pipeline([numeric_items, limit_filter(4), exhaust], stats=stats)
+    assert result is None
+    sink = list(stats.stages.values())[-1]
+    assert (sink.name, sink.items_in) == ('exhaust', 4)
+
+
+def test_as_pipeline_stats_accumulate():
+    stats = PipelineStats(interval=None)
+    for _ in range(2):
+        as_pipeline([(n for n in range(3)), exhaust], stats=stats)
+    assert list(stats.stages.values())[-1].items_in == 6
+
+
+def test_as_pipeline_stats_no_summary(mocker):
+    stats = PipelineStats(interval=None)
+    log_summary = mocker.spy(PipelineStats, 'log_summary')
+    as_pipeline([(n for n in range(3)), exhaust], stats=stats, summary=False)
+    list(as_pipeline([(n for n in range(3)), chunker(2)], stats=stats, summary=False))
+    log_summary.assert_not_called()
+    as_pipeline([(n for n in range(3)), exhaust], stats=stats)
+    log_summary.assert_called_once()
+
+
 ####################################################
 #                  Extract
 ####################################################
@@ -89,3 +138,75 @@ def test_chunker(numeric_items):
     assert len(results[1]) == 3
     assert len(results[2]) == 3
     assert len(results[3]) == 1
+
+
+def test_prefetch(numeric_items):
+    results = list(prefetch(2)(numeric_items))
+    assert results == list(range(10))
+
+
+def test_prefetch_raises_upstream_error():
+    def failing():
+        yield 1
+        raise ValueError('upstream')
+
+    items = prefetch(2)(failing())
+    assert next(items) == 1
+    with pytest.raises(ValueError, match='upstream'):
+        next(items)
+
+
+def test_prefetch_close_stops_producer():
+    closed = threading.Event()
+
+    def endless():
+        try:
+            n = 0
+            while True:
+                n += 1
+                yield n
+        finally:
+            closed.set()
+
+    items = prefetch(2)(endless())
+    assert next(items) == 1
+    items.close()
+    assert closed.is_set()
+    assert not any(t.name == 'prefetch' for t in threading.enumerate())
+
+
+####################################################
+#                  Load
+####################################################
+
+
+@pytest.fixture
+def increment_generation(mocker):
+    return mocker.patch('classifier_pipeline.utils.db.Db.increment_generation')
+
+
+def test_db_loader_batches_by_size(mocker, numeric_items, increment_generation):
+    set_many = mocker.patch('classifier_pipeline.utils.db.Db.set_many', side_effect=lambda _, b: {'inserted': len(b)})
+    results = list(db_loader(table_name='test', batch_size=4)({'id': i} for i in numeric_items))
+    assert [r['inserted'] for r in results] == [4, 4, 2]
+    assert set_many.call_count == 3
+
+
+def test_db_loader_batches_by_bytes(mocker, numeric_items, increment_generation):
+    mocker.patch('classifier_pipeline.utils.db.Db.set_many', side_effect=lambda _, b: {'inserted': len(b)})
+    items = ({'id': i, 'text': 'x' * 100} for i in numeric_items)
+    results = list(db_loader(table_name='test', batch_size=1000, max_bytes=250)(items))
+    assert [r['inserted'] for r in results] == [2, 2, 2, 2, 2]
+
+
+def test_db_loader_unbatched(mocker, dict_items, increment_generation):
+    set_one = mocker.patch('classifier_pipeline.utils.db.Db.set', return_value={'inserted': 1})
+    results = list(db_loader(table_name='test')(dict_items))
+    assert len(results) == 2
+    assert set_one.call_count == 2
+
+
+def test_db_loader_increments_generation(mocker, dict_items, increment_generation):
+    mocker.patch('classifier_pipeline.utils.db.Db.set', side_effect=[{'inserted': 1}, {'unchanged': 1}])
+    list(db_loader(table_name='test')(dict_items))
+    increment_generation.assert_called_once_with('test')